@@ -0,0 +1,128 @@
+from server import Endpoint, LazyEndpoint
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import json
+
+BATCH_WORKERS = 4  # sub-requests of one independent run that are handled concurrently
+BATCH_MAX_REQUESTS = 50
+
+MODULE = __name__.rpartition(".")[2]  # plugin module name, as used for placeholders of this plugin
+
+"""
+Endpoints:
+POST batch
+    Payload:
+    {"requests": [{"method": <GET|POST|PUT|HEAD>, "path": <path>[, "body": <str or JSON>][, "headers": {...}]
+                   [, "independent": true]}, ...]}
+    Sub-requests are handled inside the server, in order. Consecutive sub-requests marked independent are
+    handled concurrently; the next one starts when all of them are done.
+    Sub-requests to batch itself and sub-requests with headers that are not latin-1 strings get 400.
+    200 with a JSON list of {"status": <status>[, "body": <response body>]}, one per sub-request.
+"""
+
+
+class Plugin:
+    def __init__(self, rest_server):
+        self.name = "batch"
+        self.endpoint = BatchEndpoint("batch")
+        rest_server.register_endpoint(self.endpoint)
+
+    def shutdown(self):
+        self.endpoint.executor.shutdown(wait=False)
+
+
+def valid_header(name, value):
+    """
+    :return: True if name: value makes exactly one header line: both str, latin-1, without line breaks
+    """
+    if not isinstance(name, str) or not isinstance(value, str) or not name or ":" in name \
+            or any(c in name + value for c in "\r\n"):
+        return False
+    try:
+        (name + value).encode("latin-1")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+class BatchEndpoint(Endpoint):
+    def __init__(self, path, workers=BATCH_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+        super().__init__(path)
+
+    def do_POST(self, reqhandler):
+        if reqhandler.parent is not None:
+            # nested batches could wait for workers of this executor forever
+            logging.info("Refusing nested batch")
+            reqhandler.send_response(400)  # Bad Request
+            reqhandler.end_headers()
+            return
+        try:
+            clen = int(reqhandler.headers['Content-Length'])
+        except (KeyError, TypeError):
+            reqhandler.send_response(411)  # Length required
+            reqhandler.end_headers()
+            return
+        post = reqhandler.rfile.read(clen)
+        try:
+            data = json.loads(post)
+            requests = data["requests"] if isinstance(data, dict) else data
+            if not isinstance(requests, list) or len(requests) > BATCH_MAX_REQUESTS:
+                raise ValueError
+        except (ValueError, KeyError, TypeError):
+            logging.warning("Invalid batch: {}".format(post))
+            reqhandler.send_response(400)  # Bad Request
+            reqhandler.end_headers()
+            return
+
+        results = []
+        run = []  # consecutive independent sub-requests
+        for request in requests:
+            if isinstance(request, dict) and request.get("independent"):
+                run.append(request)
+                continue
+            results += self.run_parallel(reqhandler, run)
+            run = []
+            results.append(self.handle(reqhandler, request))
+        results += self.run_parallel(reqhandler, run)
+
+        reqhandler.respond(200, json.dumps(results), "application/json")
+
+    def run_parallel(self, reqhandler, requests):
+        if len(requests) < 2:
+            return [self.handle(reqhandler, el) for el in requests]
+        futures = [self.executor.submit(self.handle, reqhandler, el) for el in requests]
+        return [el.result() for el in futures]
+
+    def handle(self, reqhandler, request):
+        """
+        :return: result dict of the sub-request
+        """
+        server = reqhandler.server
+        try:
+            method = request["method"].upper()
+            path = request["path"]
+            body = request.get("body", b"")
+            headers = request.get("headers") or {}
+            if method not in ["GET", "POST", "PUT", "HEAD"] or not isinstance(path, str) \
+                    or not path.startswith("/") or not isinstance(headers, dict) \
+                    or not all(valid_header(key, value) for key, value in headers.items()):
+                raise ValueError
+        except (KeyError, TypeError, AttributeError, ValueError):
+            return {"status": 400}
+        endpoint = server.match_endpoints(path.partition("?")[0])
+        if isinstance(endpoint, BatchEndpoint) or (isinstance(endpoint, LazyEndpoint) and endpoint.module == MODULE):
+            # nested batches could wait for workers of this executor forever
+            return {"status": 400}
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        elif not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+            headers.setdefault("Content-Type", "application/json")
+
+        status, _, response = server.dispatch_internal(method, path, body, headers, reqhandler.client_address,
+                                                       parent=reqhandler)
+        result = {"status": status}
+        if response:
+            result["body"] = response.decode("utf-8", "replace")
+        return result
@@ -1,5 +1,8 @@
+from threading import Lock, Thread, Event, Condition
 import logging
+import json
 import socket
+import time
 
 from server import Endpoint
 
@@ -7,6 +10,12 @@ from server import Endpoint
 # CONFIG ###
 DENONIP = "192.168.0.3"
 DENONPORT = 23  # telnet
+TIMEOUT = 3  # seconds for connecting and sending
+COMMAND_INTERVAL = 0.05  # the receiver needs at least 50ms between commands
+KEEPALIVE_IDLE = 30  # seconds of idle time before TCP keepalive probes are sent
+STATE_TTL = 60  # seconds the cached power/input state is trusted without an update from the receiver
+QUERY_TIMEOUT = 1  # seconds to wait for answers to status queries
+COALESCE_WINDOW = 0.3  # seconds between commands of the same kind; commands arriving meanwhile are coalesced into the last one
 ############
 
 """
@@ -14,43 +23,273 @@ Endpoints:
 GET denon/switch/<toggle>
     toggle out of [on, off]
 GET denon/source/<inputsource>
-    inputsource out of [rpi, pc]
+    inputsource out of [rpi, pc, tv]
+GET denon/status
+    Cached power and input state (JSON); queried from the receiver if unknown
 """
 
 
-def send_denon(payload):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((DENONIP, DENONPORT))
-        s.sendall(payload)
+class DenonConnection:
+    def __init__(self, host, port, timeout=TIMEOUT, interval=COMMAND_INTERVAL, on_line=None, on_connect=None,
+                 on_close=None):
+        """
+        Persistent telnet connection to the receiver (it only accepts one at a time).
+        Commands are written one after another by send(); the connection is opened on first use and
+        reopened if it broke. Lines sent by the receiver are passed to on_line(line) if given,
+        on_connect() is called whenever a new connection was opened, on_close() when the receiver closed it.
+        :param timeout: Connect and send timeout in seconds
+        :param interval: Minimum time between two commands in seconds
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.interval = interval
+        self.on_line = on_line
+        self.on_connect = on_connect
+        self.on_close = on_close
+        self.lock = Lock()
+        self.sock = None
+        self.connects = 0
+        self._last = 0
 
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        self.sock = sock
+        self.connects += 1
+        logging.debug("Connected to {}:{}".format(self.host, self.port))
+        if self.on_connect is not None:
+            self.on_connect()
+        Thread(target=self._read, args=(sock,), daemon=True).start()
 
-def switch(toggle):
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def send(self, payload):
+        """
+        Sends the newline separated commands in payload; each one is terminated with CR.
+        Reconnects and retries once if the connection broke. Raises OSError if the receiver is unreachable.
+        :param payload: bytes, e.g. b"PWON" or b"PWSTANDBY\nZ2OFF"
+        """
+        commands = [el.strip() for el in payload.split(b"\n") if el.strip()]
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    for cmd in commands:
+                        wait = self._last + self.interval - time.monotonic()
+                        if wait > 0:
+                            time.sleep(wait)
+                        self.sock.sendall(cmd + b"\r")
+                        self._last = time.monotonic()
+                    return
+                except OSError as e:
+                    self._close()
+                    if attempt > 0:
+                        raise
+                    logging.info("Denon connection broke ({}), reconnecting".format(e))
+
+    def _read(self, sock):
+        buf = b""
+        while True:
+            try:
+                data = sock.recv(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            *lines, buf = buf.split(b"\r")
+            for line in lines:
+                if line and self.on_line is not None:
+                    self.on_line(line.decode("ascii", "replace"))
+
+        with self.lock:
+            if self.sock is not sock:
+                return
+            logging.debug("Denon closed the connection")
+            self._close()
+        if self.on_close is not None:
+            self.on_close()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+class _Pending:
+    __slots__ = ("value", "payload", "extra", "done", "error")
+
+    def __init__(self):
+        self.value = None
+        self.payload = None
+        self.extra = None
+        self.done = Event()
+        self.error = None
+
+
+class DenonState:
+    KEYS = ["PW", "SI"]
+
+    def __init__(self, connection, ttl=STATE_TTL, window=COALESCE_WINDOW):
+        """
+        Cached power (PW) and input (SI) state of the receiver, kept up to date from the status lines the
+        receiver sends. set() skips commands that would not change the state as last reported by the receiver. A command is sent right away
+        unless one of the same kind was sent less than window seconds ago; commands arriving within that
+        time are coalesced into the last one.
+        :param connection: DenonConnection object; its callbacks are taken over
+        :param ttl: Seconds a cached value is trusted
+        """
+        self.connection = connection
+        self.connection.on_line = self.update
+        self.connection.on_connect = self.reset
+        self.connection.on_close = self.reset
+        self.ttl = ttl
+        self.window = window
+        self.values = {}  # key: (value, time of the update)
+        self.changed = Condition()
+        self.lock = Lock()
+        self.pending = {}  # key: _Pending
+        self.flushed = {}  # key: time the last command was sent
+        self.sent = 0
+        self.skipped = 0
+        self.coalesced = 0
+
+    def update(self, line):
+        key = line[:2]
+        if key in self.KEYS and line[2:] != "?":
+            with self.changed:
+                self.values[key] = (line[2:], time.monotonic())
+                self.changed.notify_all()
+
+    def reset(self):
+        with self.changed:
+            self.values = {}
+
+    def get(self, key):
+        """
+        :return: cached value of key; None if unknown or older than ttl
+        """
+        value = self.values.get(key)
+        if value is None or time.monotonic() - value[1] > self.ttl:
+            return None
+        return value[0]
+
+    def query(self, timeout=QUERY_TIMEOUT):
+        """
+        Asks the receiver for the values that are not cached and waits up to timeout seconds for the answers.
+        :return: dict key: value (None if the receiver did not answer)
+        """
+        missing = [key for key in self.KEYS if self.get(key) is None]
+        if missing:
+            self.connection.send(b"\n".join(key.encode("ascii") + b"?" for key in missing))
+            with self.changed:
+                self.changed.wait_for(lambda: all(self.get(key) is not None for key in missing), timeout)
+        return {key: self.get(key) for key in self.KEYS}
+
+    def set(self, key, value, payload, extra=None):
+        """
+        Requests state key=value, which is reached by sending payload.
+        The first caller waits until window seconds have passed since the last command of this kind
+        (not at all if the key was idle) and sends the value requested last;
+        all callers that were coalesced into it return (or raise) when it was sent.
+        :param extra: Commands that are sent along with payload even if the state is already reached,
+                      e.g. for other zones
+        """
+        with self.lock:
+            pending = self.pending.get(key)
+            first = pending is None
+            if first:
+                pending = _Pending()
+                self.pending[key] = pending
+                wait = self.flushed.get(key, float("-inf")) + self.window - time.monotonic()
+            else:
+                self.coalesced += 1
+            pending.value = value
+            pending.payload = payload
+            pending.extra = extra
+
+        if first:
+            if wait > 0:
+                time.sleep(wait)
+            self._flush(key)
+        else:
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+    def _flush(self, key):
+        with self.lock:
+            pending = self.pending.pop(key)
+            self.flushed[key] = time.monotonic()
+        try:
+            if self.get(key) == pending.value:
+                logging.debug("Denon already at {}{}".format(key, pending.value))
+                self.skipped += 1
+                if pending.extra:
+                    self.connection.send(pending.extra)
+                return
+            payload = pending.payload
+            if pending.extra:
+                payload += b"\n" + pending.extra
+            # the receiver may ignore the command; only its answer makes the new state known
+            with self.changed:
+                self.values.pop(key, None)
+            self.connection.send(payload)
+            self.sent += 1
+        except Exception as e:
+            pending.error = e
+        finally:
+            pending.done.set()
+
+    def stats(self):
+        return {
+            "power": self.get("PW"),
+            "source": self.get("SI"),
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "coalesced": self.coalesced,
+        }
+
+
+def switch(toggle, state):
     r = 404
     if toggle == "on":
-        send_denon(b"PWON")
+        state.set("PW", "ON", b"PWON")
         r = 200
     elif toggle == "off":
-        send_denon(b"PWSTANDBY\nZ2OFF")
+        state.set("PW", "STANDBY", b"PWSTANDBY", extra=b"Z2OFF")
         r = 200
     return r
 
 
-def source(inputsource):
+def source(inputsource, state):
     m = {
-        "rpi": b"SIMPLAY",
-        "pc": b"SIBD",
-        "tv": b"SITV",
+        "rpi": "MPLAY",
+        "pc": "BD",
+        "tv": "TV",
     }
     r = 404
     if inputsource in m:
-        send_denon(m[inputsource])
+        state.set("SI", m[inputsource], b"SI" + m[inputsource].encode("ascii"))
         r = 200
     return r
 
 
 class SimpleEndpoint(Endpoint):
-    def __init__(self, server, path):
+    def __init__(self, server, path, state):
         self.server = server
+        self.state = state
         super().__init__(path)
 
     def do_GET(self, reqhandler):
@@ -58,6 +297,10 @@ class SimpleEndpoint(Endpoint):
         if len(route) > 0 and route[0] == "":
             route = route[1:]
 
+        if len(route) == 1 and route[0].lower() == "status":
+            self.status_GET(reqhandler)
+            return
+
         if len(route) < 2:
             logging.info("Incorrect denon access: {}".format(reqhandler.route))
             reqhandler.send_response(404)  # Not found
@@ -68,18 +311,36 @@ class SimpleEndpoint(Endpoint):
         r = 404
         try:
             if route[0] == "switch":
-                r = switch(route[1])
+                r = switch(route[1], self.state)
             elif route[0] == "source":
-                r = source(route[1])
+                r = source(route[1], self.state)
         except Exception as e:
             self.server.report_error(self, str(e))
             r = 500  # internal server error
         reqhandler.send_response(r)
         reqhandler.end_headers()
 
+    def status_GET(self, reqhandler):
+        try:
+            self.state.query()
+        except Exception as e:
+            self.server.report_error(self, str(e))
+            reqhandler.send_response(500)  # internal server error
+            reqhandler.end_headers()
+            return
+        reqhandler.send_response(200)
+        reqhandler.send_header("Content-Type", "application/json")
+        reqhandler.end_headers()
+        reqhandler.wfile.write(json.dumps(self.state.stats()).encode("utf-8"))
+
 
 class Plugin:
     def __init__(self, rest_server):
-        self.name = "debug"
-        endpoint = SimpleEndpoint(rest_server, "/denon")
+        self.name = "denon"
+        self.connection = DenonConnection(DENONIP, DENONPORT)
+        self.state = DenonState(self.connection)
+        endpoint = SimpleEndpoint(rest_server, "/denon", self.state)
         rest_server.register_endpoint(endpoint)
+
+    def shutdown(self):
+        self.connection.close()
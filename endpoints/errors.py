@@ -2,6 +2,17 @@ from server import Endpoint
 import logging
 import json
 
+CHUNKSIZE = 64  # errors per write to the client
+
+"""
+Endpoints:
+GET sys/errors[/all][?format=<text|json>][&since=<seq>][&limit=<n>]
+    Without since: the newest <limit> errors, newest first.
+    With since: the errors after sequence number <seq>, oldest first (for polling with a cursor).
+GET sys/errors/last[?format=<text|json>]
+Reading does not remove errors. The X-Last-Seq header carries the highest returned sequence number.
+"""
+
 
 class Plugin:
     def __init__(self, rest_server):
@@ -18,45 +29,107 @@ class ErrorReporting(Endpoint):
             route = route[1:]
         if len(route) > 0 and route[-1] == "":
             route = route[:-1]
+        if len(route) == 0:
+            route = ["all"]
 
-        if len(route) < 1:
-            logging.info("Incorrect error reporting access: {}".format(reqhandler.route))
-            reqhandler.send_response(404)  # Not found
+        try:
+            fmt = reqhandler.query.get("format", ["text"])[0]
+            since = reqhandler.query.get("since")
+            if since is not None:
+                since = int(since[0])
+            limit = reqhandler.query.get("limit")
+            if limit is not None:
+                limit = int(limit[0])
+                if limit < 0:
+                    raise ValueError
+        except ValueError:
+            logging.info("Invalid error reporting query: {}".format(reqhandler.path))
+            reqhandler.send_response(400)  # Bad Request
+            reqhandler.end_headers()
+            return
+        if fmt not in ["text", "json"]:
+            logging.info("Invalid error reporting format: {}".format(fmt))
+            reqhandler.send_response(400)  # Bad Request
             reqhandler.end_headers()
             return
 
         report = []
-        if route[0] == "all":
-            for el in server.consume_errors():
-                report.append(el)
-        elif route[0] == "last":
+        if route[0] == "all" and len(route) == 1:
+            if since is not None:
+                report = [el for _, el in server.read_errors(since, limit)]
+            else:
+                report = [el for _, el in server.read_errors()]
+                if limit is not None:
+                    report = report[len(report) - limit:] if limit else []
+                report.reverse()  # newest first
+        elif route[0] == "last" and len(route) == 1:
             if server.has_error():
-                report.append(server.consume_error())
+                report.append(server.last_error())
         else:
             logging.info("Incorrect error reporting access: {}".format(reqhandler.route))
             reqhandler.send_response(404)  # Not found
             reqhandler.end_headers()
             return
 
+        last_seq = since
+        if report:
+            last_seq = max(el.seq for el in report)
+
         reqhandler.send_response(200)  # OK
-        reqhandler.end_headers()
-        reqhandler.wfile.write(format_errors(report).encode("utf-8"))
+        if fmt == "json":
+            reqhandler.send_header("Content-Type", "application/json")
+        else:
+            reqhandler.send_header("Content-Type", "text/plain; charset=utf-8")
+        if last_seq is not None:
+            reqhandler.send_header("X-Last-Seq", str(last_seq))
+        reqhandler.start_chunked()
+
+        if fmt == "json":
+            write_chunked(reqhandler.write_chunk, iter_errors_json(report))
+        else:
+            write_chunked(reqhandler.write_chunk, iter_errors(report))
+        reqhandler.end_chunked()
         return
 
 
-def format_errors_json(errorlist):
-    r = []
-    for el in errorlist:
-        r.append(el.serializable())
-    return json.dumps(r)
+def write_chunked(write, parts):
+    """
+    Passes the string parts to write(bytes), CHUNKSIZE parts per call.
+    """
+    buf = []
+    for part in parts:
+        buf.append(part)
+        if len(buf) >= CHUNKSIZE:
+            write("".join(buf).encode("utf-8"))
+            buf = []
+    if buf:
+        write("".join(buf).encode("utf-8"))
 
 
-def format_errors(errorlist):
-    r = ""
+def iter_errors_json(errorlist):
+    yield "["
+    for i in range(len(errorlist)):
+        if i > 0:
+            yield ", "
+        yield json.dumps(errorlist[i].serializable())
+    yield "]"
+
+
+def iter_errors(errorlist):
     for i in range(len(errorlist)):
         error = errorlist[i].serializable()
-        r += "{}; {}:\n{}\n".format(error["timestamp"], error["plugin"], error["msg"])
+        if error["count"] > 1:
+            yield "{}; {} ({}x since {}):\n{}\n".format(error["timestamp"], error["plugin"], error["count"],
+                                                        error["first_seen"], error["msg"])
+        else:
+            yield "{}; {}:\n{}\n".format(error["timestamp"], error["plugin"], error["msg"])
         if i < len(errorlist) - 1:
-            r += "\n"
+            yield "\n"
 
-    return r
+
+def format_errors_json(errorlist):
+    return "".join(iter_errors_json(errorlist))
+
+
+def format_errors(errorlist):
+    return "".join(iter_errors(errorlist))
@@ -0,0 +1,23 @@
+from server import Endpoint
+
+"""
+Endpoints:
+GET sys/metrics
+    Request counts, latency histograms and plugin gauges in the Prometheus text format.
+"""
+
+
+class Plugin:
+    def __init__(self, rest_server):
+        self.name = "metrics"
+        endpoint = MetricsEndpoint("sys/metrics")
+        rest_server.register_endpoint(endpoint)
+
+
+class MetricsEndpoint(Endpoint):
+    def do_GET(self, reqhandler):
+        if reqhandler.route not in ["", "/"]:
+            reqhandler.send_response(404)  # Not found
+            reqhandler.end_headers()
+            return
+        reqhandler.respond(200, reqhandler.server.metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,59 @@
+from server import Endpoint, PluginError
+import logging
+import json
+import time
+
+"""
+Endpoints:
+GET sys/plugins
+    Loaded and lazy plugins with their endpoints (JSON)
+GET sys/plugins/reload/<module>
+    Re-imports the plugin module and replaces the running plugin without restarting the server.
+    Waits for running requests on the old endpoints; requests arriving meanwhile are served by the new ones.
+    Plugins that are not loaded (lazy or failed) are loaded.
+"""
+
+
+class Plugin:
+    def __init__(self, rest_server):
+        self.name = "plugins"
+        endpoint = PluginsEndpoint("sys/plugins")
+        rest_server.register_endpoint(endpoint)
+
+
+class PluginsEndpoint(Endpoint):
+    def do_GET(self, reqhandler):
+        route = reqhandler.route.split("/")
+        if len(route) > 0 and route[0] == "":
+            route = route[1:]
+        if len(route) > 0 and route[-1] == "":
+            route = route[:-1]
+        server = reqhandler.server
+
+        if len(route) == 0:
+            reqhandler.respond(200, json.dumps(server.plugin_info()), "application/json")
+            return
+        if len(route) != 2 or route[0] != "reload":
+            logging.info("Incorrect plugins access: {}".format(reqhandler.route))
+            reqhandler.send_response(404)  # Not found
+            reqhandler.end_headers()
+            return
+
+        name = route[1]
+        if not any(el["module"] == name for el in server.plugin_info()):
+            logging.info("Plugin {} is unknown".format(name))
+            reqhandler.send_response(404)  # Not found
+            reqhandler.end_headers()
+            return
+
+        start = time.perf_counter()
+        try:
+            server.reload_plugin(name, caller=self, enclosing=reqhandler.enclosing())
+        except PluginError as e:
+            server.report_error(self, str(e))
+            reqhandler.send_response(500)  # internal server error
+            reqhandler.end_headers()
+            return
+        info = next(el for el in server.plugin_info() if el["module"] == name)
+        info["reload_ms"] = (time.perf_counter() - start) * 1000
+        reqhandler.respond(200, json.dumps(info), "application/json")
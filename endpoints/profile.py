@@ -0,0 +1,104 @@
+from server import Endpoint
+import logging
+import json
+
+SAMPLES = 100  # requests profiled if samples is not given
+
+"""
+Endpoints:
+GET sys/profile
+    Status of the profiler (JSON)
+GET sys/profile/start[?endpoint=<path>][&samples=<n>]
+    Profiles the next <n> requests to the endpoint matching <path> (all endpoints if omitted).
+    Discards the stats of the previous run.
+GET sys/profile/stop
+GET sys/profile/report[?format=<text|pstats>][&sort=<key>][&limit=<n>]
+    Aggregated stats as pstats text report or as file to be loaded with pstats.Stats(<file>).
+"""
+
+
+class Plugin:
+    def __init__(self, rest_server):
+        self.name = "profile"
+        endpoint = ProfileEndpoint("sys/profile")
+        rest_server.register_endpoint(endpoint)
+
+
+class ProfileEndpoint(Endpoint):
+    def do_GET(self, reqhandler):
+        route = reqhandler.route.split("/")
+        if len(route) > 0 and route[0] == "":
+            route = route[1:]
+        if len(route) > 0 and route[-1] == "":
+            route = route[:-1]
+        profiler = reqhandler.server.profiler
+
+        if len(route) == 0:
+            self.send_status(reqhandler)
+        elif route == ["start"]:
+            self.start_GET(reqhandler)
+        elif route == ["stop"]:
+            profiler.stop()
+            self.send_status(reqhandler)
+        elif route == ["report"]:
+            self.report_GET(reqhandler)
+        else:
+            logging.info("Incorrect profile access: {}".format(reqhandler.route))
+            reqhandler.send_response(404)  # Not found
+            reqhandler.end_headers()
+
+    def start_GET(self, reqhandler):
+        server = reqhandler.server
+        endpoint = None
+        try:
+            samples = int(reqhandler.query.get("samples", [SAMPLES])[0])
+            if samples < 1:
+                raise ValueError
+            path = reqhandler.query.get("endpoint")
+            if path is not None:
+                endpoint = server.match_endpoints(path[0])
+                if endpoint is None:
+                    raise ValueError
+        except ValueError:
+            logging.info("Invalid profile query: {}".format(reqhandler.path))
+            reqhandler.send_response(400)  # Bad Request
+            reqhandler.end_headers()
+            return
+
+        server.profiler.start(samples, endpoint.path if endpoint else None)
+        logging.info("Profiling the next {} requests to {}".format(samples, endpoint.path if endpoint else "all"))
+        self.send_status(reqhandler)
+
+    def report_GET(self, reqhandler):
+        profiler = reqhandler.server.profiler
+        fmt = reqhandler.query.get("format", ["text"])[0]
+        if fmt not in ["text", "pstats"]:
+            reqhandler.send_response(400)  # Bad Request
+            reqhandler.end_headers()
+            return
+        if not profiler.has_stats():
+            reqhandler.send_response(404)  # Not found
+            reqhandler.end_headers()
+            return
+
+        if fmt == "pstats":
+            body = profiler.dump()
+            content_type = "application/octet-stream"
+        else:
+            try:
+                sort = reqhandler.query.get("sort", ["cumulative"])[0]
+                limit = int(reqhandler.query.get("limit", [50])[0])
+                body = profiler.report(sort, limit).encode("utf-8")
+            except (ValueError, KeyError):
+                reqhandler.send_response(400)  # Bad Request
+                reqhandler.end_headers()
+                return
+            content_type = "text/plain; charset=utf-8"
+
+        headers = {}
+        if fmt == "pstats":
+            headers["Content-Disposition"] = "attachment; filename=\"profile.pstats\""
+        reqhandler.respond(200, body, content_type, headers)
+
+    def send_status(self, reqhandler):
+        reqhandler.respond(200, json.dumps(reqhandler.server.profiler.status()), "application/json")
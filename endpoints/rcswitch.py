@@ -1,23 +1,48 @@
 from server import Endpoint
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 import logging
-import os
+import subprocess
+import json
+import time
 
+# CONFIG ###
 RCSWITCHCMD = "rcswitch"
+RCSWITCH_BATCH = False  # True if RCSWITCHCMD accepts several channels at once: rcswitch a b c d on
+RCSWITCH_DEBOUNCE = 0.2  # seconds to collect commands before sending; only the last one per channel is sent
+############
+
+CHANNELS = ["a", "b", "c", "d"]
 
 """
 Endoint:
 GET rcswitch/<switch>/<toggle>
 switch out of [a, b, c, d, all]
 toggle out of [on, off]
+Answers 202 once the command is queued; it is sent in the background.
+Commands for the same channel within RCSWITCH_DEBOUNCE seconds replace each other.
+GET rcswitch/stats
+    Counters of sent and coalesced commands (JSON)
 """
 
 
 class RCEndpoint(Endpoint):
+    def __init__(self, path, switcher):
+        self.switcher = switcher
+        super().__init__(path)
+
     def do_GET(self, reqhandler):
         route = reqhandler.route.split("/")
         if len(route) > 0 and route[0] == "":
             route = route[1:]
 
+        if len(route) == 1 and route[0].lower() == "stats":
+            reqhandler.send_response(200)
+            reqhandler.send_header("Content-Type", "application/json")
+            reqhandler.end_headers()
+            reqhandler.wfile.write(json.dumps(self.switcher.stats()).encode("utf-8"))
+            return
+
         if len(route) < 2:
             logging.info("Incorrect rswitch access: {}".format(reqhandler.route))
             reqhandler.send_response(404)  # Not found
@@ -25,7 +50,7 @@ class RCEndpoint(Endpoint):
             return
         route[0] = route[0].lower()
         route[1] = route[1].lower()
-        if route[0].lower() not in ["a", "b", "c", "d", "all"]:
+        if route[0] not in CHANNELS + ["all"]:
             logging.warning("Invalid channel: {}".format(route[0]))
             reqhandler.send_response(400)  # Bad Request
             reqhandler.end_headers()
@@ -36,22 +61,116 @@ class RCEndpoint(Endpoint):
             reqhandler.end_headers()
             return
 
-        if route[0] is "all":
-            for el in ["a", "b", "c", "d"]:
-                rcswitch(el, route[1])
+        if route[0] == "all":
+            self.switcher.submit(CHANNELS, route[1])
         else:
-            rcswitch(route[0], route[1])
+            self.switcher.submit([route[0]], route[1])
 
         reqhandler.send_response(202)  # Accepted
         reqhandler.end_headers()
 
 
+class Switcher:
+    def __init__(self, plugin=None, command=RCSWITCHCMD, batch=RCSWITCH_BATCH, debounce=RCSWITCH_DEBOUNCE):
+        """
+        Runs rcswitch commands on a single background thread, so requests don't wait for the
+        transmitter and two commands are never sent at the same time.
+        Each channel has one pending slot: a command replaces the pending one of its channel,
+        so of on/off/on within debounce seconds only the last "on" is sent.
+        :param batch: Pass all channels with the same toggle to one command invocation
+        :param debounce: Seconds to wait for further commands before sending
+        """
+        self.plugin = plugin
+        self.command = command
+        self.batch = batch
+        self.debounce = debounce
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rcswitch")
+        self.lock = Lock()
+        self.pending = {}  # channel: toggle
+        self.flush_future = None  # Future of the flush that sends self.pending
+        self.sent = 0
+        self.coalesced = 0
+
+    def submit(self, channels, toggle):
+        """
+        Queues switching channels to toggle.
+        :return: Future of the flush sending the command, resolving to the list of return codes
+        """
+        with self.lock:
+            for channel in channels:
+                if channel in self.pending:
+                    self.coalesced += 1
+                    # re-insert so the channel is sent in the order of the last command
+                    del self.pending[channel]
+                self.pending[channel] = toggle
+            if self.flush_future is None:
+                self.flush_future = self.executor.submit(self.flush)
+            return self.flush_future
+
+    def flush(self):
+        if self.debounce:
+            time.sleep(self.debounce)
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.flush_future = None
+
+        groups = []  # (channels, toggle)
+        for channel, toggle in pending.items():
+            group = None
+            if self.batch:
+                group = next((el for el in groups if el[1] == toggle), None)
+            if group is None:
+                groups.append(([channel], toggle))
+            else:
+                group[0].append(channel)
+        return [self.run(channels, toggle) for channels, toggle in groups]
+
+    def run(self, channels, toggle):
+        try:
+            r = rcswitch(channels, toggle, self.command)
+        except OSError as e:
+            r = None
+            msg = "{} {} {} failed: {}".format(self.command, " ".join(channels), toggle, e)
+        else:
+            msg = "{} {} {} exited with {}".format(self.command, " ".join(channels), toggle, r)
+        self.sent += len(channels)
+        if r != 0:
+            logging.warning(msg)
+            if self.plugin is not None:
+                self.plugin.report_error(msg)
+        return r
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
 class Plugin:
     def __init__(self, rest_server):
         self.name = "rcswitch"
-        endpoint = RCEndpoint("rcswitch")
+        self.server = rest_server
+        self.switcher = Switcher(self)
+        endpoint = RCEndpoint("rcswitch", self.switcher)
         rest_server.register_endpoint(endpoint)
 
+    def report_error(self, msg):
+        self.server.report_error(self, msg)
+
+    def shutdown(self):
+        self.switcher.shutdown()
+
 
-def rcswitch(channel, toggle):
-    return os.system("{} {} {}".format(RCSWITCHCMD, channel, toggle))
+def rcswitch(channels, toggle, command=RCSWITCHCMD):
+    """
+    Runs command directly (without a shell) for the given channels.
+    :return: exit status
+    """
+    return subprocess.run([command] + list(channels) + [toggle], stdin=subprocess.DEVNULL).returncode
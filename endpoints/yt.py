@@ -1,10 +1,16 @@
 from server import Endpoint
+from util import Journal
 from threading import Thread, Lock, Event
 from enum import Enum
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urlsplit, parse_qs
 import logging
+import glob
 import os
 import re
 import json
+import time
 import subprocess
 
 
@@ -12,13 +18,41 @@ import subprocess
 # config ##
 VIDEODIR = "videos"
 DEFAULTVOL = -3300
+WATCH_INTERVAL = None  # seconds between checks of VIDEODIR for files added out of band; None disables
+CACHE_MAX_BYTES = None  # download cache quota; least recently played videos are evicted; None for no limit
+CACHE_MAX_FILES = None
+DOWNLOAD_WORKERS = 2  # concurrent youtube-dl downloads
+PREFETCH_DEPTH = 2  # videos downloaded ahead of the one that is playing
+DOWNLOAD_RATE_LIMIT = None  # youtube-dl --limit-rate, e.g. "2M"; None for no limit
+RESOLVE_CACHE_SIZE = 128  # resolved stream URLs kept in memory
+RESOLVE_TTL = 3600  # seconds a resolved stream URL is used if it carries no expire parameter
+RESOLVE_MARGIN = 300  # seconds before expiry a resolved stream URL is no longer used
+RESOLVE_REFRESH_HITS = None  # re-resolve URLs with at least this many hits in the background; None disables
+QUEUE_CAPACITY = 100  # maximum backlog of the download and streaming queues; None for no limit
+QUEUE_RETRY_AFTER = 60  # seconds clients are asked to wait when a queue is full
+JOURNALDIR = "journal"  # queues are persisted here and restored on startup; None disables
+JOURNAL_FSYNC_INTERVAL = 1  # seconds between fsyncs of the queue journals; 0: fsync every change
+EXTRACTOR = "cli"  # out of [cli, library, stub]; library keeps youtube_dl/yt_dlp imported, falls back to cli
+DOWNLOAD_FORMAT = "bestvideo[ext=mp4]+bestaudio[ext=m4a]"
+PLAYLIST_MAX_ITEMS = 500  # videos taken from a shared playlist
 #######
 
 """
 Endpoint:
-GET /linkshare
+POST /linkshare
     Payload:
     {"link": <youtubelink>}
+    202 if queued, 503 with Retry-After if the queue is full
+    {"links": [<youtubelink or playlistlink>, ...]} (or just the list)
+    All videos are queued at once; playlists are expanded in the background and queued when done.
+    JSON list of per-link results {"link", "status": <queued|expanding|invalid|full>, "id"|"playlist"};
+    202 if anything was queued or is being expanded, else 503 (with Retry-After) if the queue is full, else 422
+GET /linkshare/queue
+    Queue depth, backlog and wait times (JSON)
+GET /linkshare/cache
+    Download cache usage, hit rate and evictions (JSON)
+GET /linkshare/cache/<pin|unpin>/<videoid>
+    Pinned videos are never evicted from the download cache
 """
 
 
@@ -34,28 +68,235 @@ class PlayerError(Exception):
     pass
 
 
+class QueueFull(Exception):
+    pass
+
+
 class Plugin:
     def __init__(self, rest_server):
         self.name = "yt"
         self.server = rest_server
 
         logging.info("Setting up yt plugin ...")
-        player = Player(self)
-        downloader = Downloader(VIDEODIR, player, self)
-        streamer = Streamer(VIDEODIR, player, self)
+        extractor = make_extractor(EXTRACTOR)
+        self.cache = VideoCache(VIDEODIR, WATCH_INTERVAL, CACHE_MAX_BYTES, CACHE_MAX_FILES)
+        self.journals = []
+        player = Player(self, self.cache, journal=self.open_journal("player"))
+        downloader = Downloader(VIDEODIR, player, self, self.cache, extractor=extractor,
+                                journal=self.open_journal("downloader"))
+        player.on_finished = downloader.prefetch
+        streamer = Streamer(VIDEODIR, player, self, extractor=extractor, journal=self.open_journal("streamer"))
+        self.queues = {"downloader": downloader, "streamer": streamer, "player": player}
         self.endpoint = LinkshareEndpoint("/linkshare", downloader, streamer, self)
         rest_server.register_endpoint(self.endpoint)
+        rest_server.metrics.add_collector(self.collect_metrics)
 
     def report_error(self, msg):
         self.server.report_error(self, msg)
 
+    def collect_metrics(self):
+        """
+        Queue gauges for the server metrics; see metrics.Metrics.add_collector().
+        """
+        stats = {name: queue.stats() for name, queue in self.queues.items()}
+        return [
+            ("yt_queue_depth", "gauge", "Elements waiting in the queue.",
+             [({"queue": name}, el["depth"]) for name, el in stats.items()]),
+            ("yt_queue_backlog", "gauge", "Elements queued or being consumed.",
+             [({"queue": name}, el["backlog"]) for name, el in stats.items()]),
+            ("yt_queue_oldest_age_seconds", "gauge", "Time the oldest waiting element has been queued.",
+             [({"queue": name}, el["oldest_wait"] or 0) for name, el in stats.items()]),
+            ("yt_queue_consumed_total", "counter", "Elements consumed.",
+             [({"queue": name}, el["consumed"]) for name, el in stats.items()]),
+            ("yt_queue_consume_seconds_total", "counter", "Time spent consuming elements.",
+             [({"queue": name}, el["consume_time"]) for name, el in stats.items()]),
+            ("yt_queue_rejected_total", "counter", "Elements rejected because the queue was full.",
+             [({"queue": name}, el["rejected"]) for name, el in stats.items()]),
+        ]
+
+    def open_journal(self, name):
+        if JOURNALDIR is None:
+            return None
+        os.makedirs(JOURNALDIR, exist_ok=True)
+        journal = Journal(os.path.join(JOURNALDIR, name + ".journal"), JOURNAL_FSYNC_INTERVAL)
+        self.journals.append(journal)
+        return journal
+
+    def shutdown(self):
+        self.server.metrics.remove_collector(self.collect_metrics)
+        self.endpoint.expander.shutdown(wait=False)
+        for queue in self.queues.values():
+            queue.stop()
+        self.cache.stop()
+        for journal in self.journals:
+            journal.close()
+
+
+class Extractor:
+    """
+    youtube-dl backend. resolve() and download() raise DownloadError on failure.
+    """
+    name = None
+
+    def resolve(self, videoid):
+        """
+        :return: (video URL, audio URL) of videoid
+        """
+        raise NotImplementedError()
+
+    def download(self, videoid, videodir, rate_limit=None):
+        """
+        Downloads videoid to videodir/videoid.ext.
+        :param rate_limit: download rate limit, e.g. "2M"; None for no limit
+        """
+        raise NotImplementedError()
+
+    def playlist(self, listid):
+        """
+        :return: list of the video ids in playlist listid
+        """
+        raise NotImplementedError()
+
+
+class CLIExtractor(Extractor):
+    """
+    Spawns a youtube-dl process per call.
+    """
+    name = "cli"
+
+    def resolve(self, videoid):
+        proc = subprocess.run(["youtube-dl", "-g", yt_url(videoid)], capture_output=True)
+        stdout = proc.stdout.decode("utf-8").split("\n")
+        if len(stdout) != 3:
+            raise DownloadError("youtube-dl -g failed on {}".format(videoid))
+        return tuple(stdout[:-1])
+
+    def download(self, videoid, videodir, rate_limit=None):
+        cmd = ["youtube-dl", yt_url(videoid), "-f", DOWNLOAD_FORMAT, "-o", videodir + "/%(id)s.%(ext)s"]
+        if rate_limit:
+            cmd += ["-r", rate_limit]
+        if subprocess.run(cmd).returncode != 0:
+            raise DownloadError("youtube-dl failed on {}".format(videoid))
+
+    def playlist(self, listid):
+        proc = subprocess.run(["youtube-dl", "--flat-playlist", "--get-id", yt_playlist_url(listid)],
+                              capture_output=True)
+        if proc.returncode != 0:
+            raise DownloadError("youtube-dl failed on playlist {}".format(listid))
+        return [el for el in proc.stdout.decode("utf-8").split("\n") if el]
+
+
+class LibraryExtractor(Extractor):
+    """
+    Uses youtube_dl (or yt_dlp) in-process, so interpreter startup and extractor imports are paid only once.
+    """
+    name = "library"
 
-class Queue(Thread):
     def __init__(self):
+        try:
+            import youtube_dl as ytdl
+        except ImportError:
+            import yt_dlp as ytdl
+        self.ytdl = ytdl
+
+    def _run(self, videoid, opts, download, url=None):
+        opts = dict(opts, quiet=True, no_warnings=True)
+        try:
+            with self.ytdl.YoutubeDL(opts) as ydl:
+                return ydl.extract_info(url or yt_url(videoid), download=download)
+        except Exception as e:
+            raise DownloadError("youtube-dl failed on {} ({})".format(videoid, e))
+
+    def resolve(self, videoid):
+        info = self._run(videoid, {"format": "bestvideo+bestaudio"}, False)
+        formats = info.get("requested_formats") or []
+        if len(formats) != 2:
+            raise DownloadError("youtube-dl found no separate video and audio stream for {}".format(videoid))
+        return tuple(el["url"] for el in formats)
+
+    def download(self, videoid, videodir, rate_limit=None):
+        opts = {"format": DOWNLOAD_FORMAT, "outtmpl": videodir + "/%(id)s.%(ext)s"}
+        if rate_limit:
+            opts["ratelimit"] = parse_bytes(rate_limit)
+        self._run(videoid, opts, True)
+
+    def playlist(self, listid):
+        info = self._run(listid, {"extract_flat": "in_playlist"}, False, yt_playlist_url(listid))
+        return [el["id"] for el in info.get("entries") or [] if el and el.get("id")]
+
+
+class StubExtractor(Extractor):
+    """
+    Offline extractor for tests and benchmarks: resolves to fake URLs and downloads empty files.
+    """
+    name = "stub"
+
+    def __init__(self, delay=0):
+        """
+        :param delay: seconds every call takes
+        """
+        self.delay = delay
+
+    def playlist(self, listid):
+        time.sleep(self.delay)
+        return ["{}-{}".format(listid, i) for i in range(3)]
+
+    def resolve(self, videoid):
+        time.sleep(self.delay)
+        expire = int(time.time()) + 6 * 3600
+        return tuple("https://stub.invalid/videoplayback?id={}&itag={}&expire={}".format(videoid, itag, expire)
+                     for itag in [137, 140])
+
+    def download(self, videoid, videodir, rate_limit=None):
+        time.sleep(self.delay)
+        open("{}/{}.mp4".format(videodir, videoid), "wb").close()
+
+
+EXTRACTORS = {
+    CLIExtractor.name: CLIExtractor,
+    LibraryExtractor.name: LibraryExtractor,
+    StubExtractor.name: StubExtractor,
+}
+
+
+def make_extractor(name):
+    """
+    :param name: out of EXTRACTORS; falls back to the cli extractor if the backend is not available
+    :return: Extractor object
+    """
+    try:
+        return EXTRACTORS[name]()
+    except (KeyError, ImportError) as e:
+        logging.warning("Extractor {} not available ({}), using cli".format(name, e))
+        return CLIExtractor()
+
+
+class Queue(Thread):
+    def __init__(self, journal=None, capacity=None):
+        """
+        :param journal: util.Journal object. If given, appended elements are recorded in the journal until they
+                        are consumed, and elements left over from a previous run are consumed again.
+        :param capacity: Maximum backlog; append() raises QueueFull when it is reached. None for no limit.
+        """
         self.lock = Lock()
-        self.queue = []
+        self.queue = deque()  # (seq, el, enqueue time)
         self.update_event = Event()
-        super().__init__()
+        self.journal = journal
+        self.capacity = capacity
+        self.active = 0
+        self.consumed = 0
+        self.rejected = 0
+        self.wait_time = 0  # total seconds consumed elements spent in the queue
+        self.consume_time = 0  # total seconds spent in consume
+        self.stopped = False
+        super().__init__(daemon=True)
+
+        if self.journal is not None:
+            pending = self.journal.pending()
+            if pending:
+                logging.info("Restoring {} elements from {}".format(len(pending), self.journal.path))
+            for seq, el in pending:
+                self._push(seq, el)
         self.start()
 
     def consume(self, el):
@@ -65,20 +306,401 @@ class Queue(Thread):
         """
         raise NotImplementedError()
 
+    def consume_item(self, seq, el):
+        """
+        Consumes el and marks it as done in the journal. Subclasses that finish elements asynchronously
+        override this and call task_done(seq) themselves.
+        :param seq: Journal sequence number of el; None without journal
+        """
+        try:
+            self.consume(el)
+        finally:
+            self.task_done(seq)
+
+    def task_done(self, seq):
+        if self.journal is not None and seq is not None:
+            self.journal.done(seq)
+
+    def finished(self, el):
+        """
+        Is called after el was consumed.
+        """
+        pass
+
+    def backlog(self):
+        """
+        :return: Number of elements that are queued or being consumed
+        """
+        return len(self.queue) + self.active
+
+    def stats(self):
+        with self.lock:
+            oldest = None
+            if self.queue:
+                oldest = time.time() - self.queue[0][2]
+            return {
+                "depth": len(self.queue),
+                "backlog": self.backlog(),
+                "capacity": self.capacity,
+                "oldest_wait": oldest,
+                "consumed": self.consumed,
+                "rejected": self.rejected,
+                "avg_wait": self.wait_time / self.consumed if self.consumed else None,
+                "avg_consume": self.consume_time / self.consumed if self.consumed else None,
+                "consume_time": self.consume_time,
+            }
+
     def append(self, el):
+        """
+        Raises QueueFull if the capacity of the queue is reached.
+        """
         with self.lock:
-            self.queue.append(el)
+            if self.capacity is not None and self.backlog() >= self.capacity:
+                self.rejected += 1
+                raise QueueFull()
+            seq = None
+            if self.journal is not None:
+                seq = self.journal.add(el)
+            self.queue.append((seq, el, time.time()))
+        self.update_event.set()
+
+    def extend(self, els):
+        """
+        Appends as many of els as the capacity allows, with one journal write and one lock acquisition.
+        :return: number of appended elements; they are the first ones of els
+        """
+        els = list(els)
+        with self.lock:
+            accepted = els
+            if self.capacity is not None:
+                accepted = els[:max(0, self.capacity - self.backlog())]
+            self.rejected += len(els) - len(accepted)
+            if not accepted:
+                return 0
+            seqs = [None] * len(accepted)
+            if self.journal is not None:
+                seqs = self.journal.add_many(accepted)
+            now = time.time()
+            self.queue.extend((seq, el, now) for seq, el in zip(seqs, accepted))
+        self.update_event.set()
+        logging.info("Added {} elements to {}".format(len(accepted), type(self).__name__))
+        return len(accepted)
+
+    def _push(self, seq, el):
+        with self.lock:
+            self.queue.append((seq, el, time.time()))
+        self.update_event.set()
+
+    def stop(self):
+        """
+        Stops consuming after the current element. Queued elements stay in the journal for the next run.
+        """
+        self.stopped = True
         self.update_event.set()
 
     def run(self):
         while True:
             self.update_event.wait()
             with self.lock:
-                to_consume = self.queue
-                self.queue = []
-                self.update_event.clear()
-            for el in to_consume:
-                self.consume(el)
+                if self.stopped:
+                    return
+                if not self.queue:
+                    self.update_event.clear()
+                    continue
+                seq, el, enqueued = self.queue.popleft()
+                self.active += 1
+            start = time.time()
+            try:
+                self.consume_item(seq, el)
+            except Exception as e:
+                logging.error("{} failed to consume {} ({})".format(type(self).__name__, el, e))
+            end = time.time()
+            with self.lock:
+                self.active -= 1
+                self.consumed += 1
+                self.wait_time += start - enqueued
+                self.consume_time += end - start
+            self.finished(el)
+
+
+class CacheEntry:
+    __slots__ = ("ext", "size", "last_played")
+
+    def __init__(self, ext, size, last_played):
+        self.ext = ext
+        self.size = size
+        self.last_played = last_played
+
+
+class VideoCache:
+    def __init__(self, videodir, watch_interval=None, max_bytes=None, max_files=None):
+        """
+        Index of the video files in videodir, keyed by video id. Files are expected to be named videoid.ext.
+        The index is updated incrementally with add() and remove(); scan() syncs it with the files on disk.
+        The play time of a video is kept as the modification time of its file, so the order survives restarts.
+        If a quota is set, the least recently played videos are evicted; pinned videos and videos that are
+        queued for playback (acquire() until release()) are never evicted.
+        :param videodir: Directory where the videos are stored; created if missing
+        :param watch_interval: If set, videodir is checked for changes every watch_interval seconds and
+                               rescanned in the background when it changed.
+        :param max_bytes: Maximum total size of the cached videos; None for no limit
+        :param max_files: Maximum number of cached videos; None for no limit
+        """
+        self.videodir = videodir
+        if os.path.exists(self.videodir):
+            if not os.path.isdir(self.videodir):
+                raise NotADirectoryError(self.videodir)
+        else:
+            os.mkdir(self.videodir)
+
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.lock = Lock()
+        self.index = OrderedDict()  # least recently played first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pinned = set()
+        self._inuse = {}
+        self._mtime = None
+        self._pinfile = os.path.join(self.videodir, ".pinned")
+        self._load_pins()
+        self.scan()
+
+        self._watcher = None
+        self._stop = Event()
+        if watch_interval:
+            self._watcher = Thread(target=self._watch, args=(watch_interval,), daemon=True)
+            self._watcher.start()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, videoid):
+        return videoid in self.index
+
+    def path(self, videoid, ext):
+        return "{}/{}{}".format(self.videodir, videoid, ext)
+
+    def scan(self):
+        """
+        Syncs the index with the files in videodir: entries of files that are gone are dropped, new files are
+        added by their modification time. Known entries keep their play time and position.
+        """
+        mtime = os.stat(self.videodir).st_mtime_ns
+        found = {}
+        for el in os.scandir(self.videodir):
+            parsed = parse_filename(el.name)
+            if parsed is None or not el.is_file():
+                continue
+            st = el.stat()
+            found[parsed[0]] = CacheEntry(parsed[1], st.st_size, st.st_mtime)
+
+        with self.lock:
+            entries = []
+            for videoid, entry in found.items():
+                known = self.index.get(videoid)
+                if known is not None and known.ext == entry.ext:
+                    known.size = entry.size
+                    entry = known
+                entries.append((videoid, entry))
+            entries.sort(key=lambda x: x[1].last_played)
+            self.index = OrderedDict(entries)
+            self.size = sum(entry.size for _, entry in entries)
+            self._mtime = mtime
+            evicted = self._evict()
+        self._delete(evicted)
+
+    def get(self, videoid):
+        """
+        :return: path of the video file; None if videoid is not cached
+        """
+        entry = self.index.get(videoid)
+        if entry is None:
+            return None
+        return self.path(videoid, entry.ext)
+
+    def acquire(self, videoid):
+        """
+        Looks up videoid and protects it from eviction until release() is called. Counts as cache hit or miss.
+        :return: path of the video file; None if videoid is not cached
+        """
+        with self.lock:
+            entry = self.index.get(videoid)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._inuse[videoid] = self._inuse.get(videoid, 0) + 1
+            return self.path(videoid, entry.ext)
+
+    def release(self, videoid, played=True):
+        """
+        Ends the protection of acquire() or add().
+        :param played: If True, videoid becomes the most recently played video.
+        """
+        with self.lock:
+            n = self._inuse.get(videoid, 0) - 1
+            if n > 0:
+                self._inuse[videoid] = n
+            else:
+                self._inuse.pop(videoid, None)
+            entry = self.index.get(videoid)
+            if entry is not None and played:
+                entry.last_played = time.time()
+                self.index.move_to_end(videoid)
+            evicted = self._evict()
+        if entry is not None and played:
+            # atime is not reliable (noatime, relatime); the play time is kept in mtime for scan()
+            try:
+                os.utime(self.path(videoid, entry.ext), (entry.last_played, entry.last_played))
+            except OSError as e:
+                logging.warning("Unable to store the play time of {} ({})".format(videoid, e))
+        self._delete(evicted)
+
+    def add(self, videoid):
+        """
+        Adds a freshly downloaded video to the index and protects it like acquire(); only looks at the files
+        named videoid.* Other videos are evicted if the quota is exceeded.
+        :return: path of the video file; None if no file was found
+        """
+        for el in glob.iglob(self.path(glob.escape(videoid), ".*")):
+            parsed = parse_filename(os.path.basename(el))
+            if parsed is None or parsed[0] != videoid:
+                continue
+            size = os.path.getsize(el)
+            with self.lock:
+                old = self.index.pop(videoid, None)
+                if old is not None:
+                    self.size -= old.size
+                self.index[videoid] = CacheEntry(parsed[1], size, time.time())
+                self.size += size
+                self._inuse[videoid] = self._inuse.get(videoid, 0) + 1
+                evicted = self._evict()
+            self._delete(evicted)
+            return self.path(videoid, parsed[1])
+        return None
+
+    def remove(self, videoid):
+        """
+        Deletes the video file and removes it from the index.
+        """
+        with self.lock:
+            entry = self.index.pop(videoid, None)
+            if entry is not None:
+                self.size -= entry.size
+        if entry is not None:
+            self._delete([(videoid, entry)])
+
+    def pin(self, videoid):
+        """
+        Pinned videos are never evicted.
+        """
+        with self.lock:
+            self.pinned.add(videoid)
+            self._save_pins()
+
+    def unpin(self, videoid):
+        with self.lock:
+            self.pinned.discard(videoid)
+            self._save_pins()
+            evicted = self._evict()
+        self._delete(evicted)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "files": len(self.index),
+                "bytes": self.size,
+                "max_files": self.max_files,
+                "max_bytes": self.max_bytes,
+                "pinned": len(self.pinned),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+            }
+
+    def _over_quota(self, files, size):
+        if self.max_files is not None and files > self.max_files:
+            return True
+        if self.max_bytes is not None and size > self.max_bytes:
+            return True
+        return False
+
+    def _evict(self):
+        """
+        Removes the least recently played entries from the index until the quota is met. Caller holds the lock.
+        :return: list of evicted (videoid, entry) tuples; their files are to be deleted with _delete()
+        """
+        files = len(self.index)
+        size = self.size
+        evicted = []
+        if not self._over_quota(files, size):
+            return evicted
+        for videoid, entry in self.index.items():
+            if not self._over_quota(files, size):
+                break
+            if videoid in self.pinned or videoid in self._inuse:
+                continue
+            evicted.append((videoid, entry))
+            files -= 1
+            size -= entry.size
+        for videoid, entry in evicted:
+            del self.index[videoid]
+        self.size = size
+        self.evictions += len(evicted)
+        return evicted
+
+    def _delete(self, entries):
+        for videoid, entry in entries:
+            logging.info("Removing {} from video cache".format(videoid))
+            try:
+                os.remove(self.path(videoid, entry.ext))
+            except OSError as e:
+                logging.warning("Unable to remove {} ({})".format(self.path(videoid, entry.ext), e))
+
+    def _load_pins(self):
+        try:
+            with open(self._pinfile) as f:
+                self.pinned = set(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            self.pinned = set()
+
+    def _save_pins(self):
+        with open(self._pinfile, "w") as f:
+            f.write("".join(videoid + "\n" for videoid in sorted(self.pinned)))
+
+    def stop(self):
+        """
+        Stops watching videodir.
+        """
+        self._stop.set()
+
+    def _watch(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                if os.stat(self.videodir).st_mtime_ns != self._mtime:
+                    logging.debug("{} changed, rescanning".format(self.videodir))
+                    self.scan()
+            except OSError as e:
+                logging.warning("Unable to watch {} ({})".format(self.videodir, e))
+
+
+def parse_filename(filename):
+    """
+    Splits a video file name into video id and extension.
+    Hidden files and youtube-dl intermediate files (.part, .ytdl, videoid.f137.mp4) are ignored.
+    :return: (videoid, ext); None if filename is not a finished video file
+    """
+    if filename.startswith("."):
+        return None
+    videoid, ext = os.path.splitext(filename)
+    if not videoid or ext in [".part", ".ytdl", ".temp"] or re.search(r"\.f\d+$", videoid):
+        return None
+    return videoid, ext
 
 
 class StreamPlayer(Thread):
@@ -99,61 +721,218 @@ class StreamPlayer(Thread):
                 self.plugin.report_error(msg)
 
 
+class ResolvedURLs:
+    __slots__ = ("urls", "expires", "hits")
+
+    def __init__(self, urls, expires):
+        self.urls = urls
+        self.expires = expires
+        self.hits = 0
+
+
+class ResolveCache:
+    def __init__(self, size=RESOLVE_CACHE_SIZE, ttl=RESOLVE_TTL, margin=RESOLVE_MARGIN):
+        """
+        LRU cache for resolved stream URLs, keyed by video id. Entries expire margin seconds before the
+        earliest expire parameter of their URLs (signed googlevideo URLs); ttl is used if there is none.
+        :param size: Maximum number of entries
+        """
+        self.size = size
+        self.ttl = ttl
+        self.margin = margin
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, videoid):
+        """
+        :return: tuple of URLs; None if videoid is not cached or expired
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(videoid)
+            if entry is None or entry.expires <= now:
+                if entry is not None:
+                    del self.entries[videoid]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(videoid)
+            entry.hits += 1
+            self.hits += 1
+            return entry.urls
+
+    def put(self, videoid, urls):
+        expires = [url_expiry(url) for url in urls]
+        expires = [el for el in expires if el is not None]
+        if expires:
+            expires = min(expires) - self.margin
+        else:
+            expires = time.time() + self.ttl
+
+        with self.lock:
+            old = self.entries.pop(videoid, None)
+            entry = ResolvedURLs(tuple(urls), expires)
+            if old is not None:
+                entry.hits = old.hits
+            self.entries[videoid] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def expiring(self, within, min_hits):
+        """
+        :return: list of video ids with at least min_hits hits that expire in less than within seconds
+        """
+        deadline = time.time() + within
+        with self.lock:
+            return [videoid for videoid, entry in self.entries.items()
+                    if entry.hits >= min_hits and entry.expires <= deadline]
+
+
+def url_expiry(url):
+    """
+    :return: value of the expire parameter (query or /expire/<ts>/ path segment) of url; None if missing
+    """
+    split = urlsplit(url)
+    expire = parse_qs(split.query).get("expire")
+    if expire:
+        expire = expire[0]
+    else:
+        m = re.search(r"/expire/(\d+)", split.path)
+        if m is None:
+            return None
+        expire = m.group(1)
+    try:
+        return int(expire)
+    except ValueError:
+        return None
+
+
 class Streamer(Queue):
-    def __init__(self, videodir, player, plugin=None):
+    def __init__(self, videodir, player, plugin=None, refresh_hits=RESOLVE_REFRESH_HITS, extractor=None,
+                 journal=None, capacity=QUEUE_CAPACITY):
         """
         Streaming player. Use append() to request a stream.
+        Resolved stream URLs are cached until shortly before they expire.
         :param videodir: Not used
         :param player: Player object
         :param plugin: Plugin object to report errors to. Can be omitted.
+        :param refresh_hits: If set, cached URLs of videos that were streamed at least refresh_hits times
+                             are re-resolved in the background before they expire.
+        :param extractor: Extractor object; created from EXTRACTOR if omitted.
+        :param journal: util.Journal object to persist the queue. Can be omitted.
+        :param capacity: Maximum number of queued streams; None for no limit.
         """
         self.plugin = plugin
-        super().__init__()
+        self.extractor = extractor
+        if self.extractor is None:
+            self.extractor = make_extractor(EXTRACTOR)
+        self.resolved = ResolveCache()
+        super().__init__(journal, capacity)
+
+        self._refresher = None
+        self._stop_refresh = Event()
+        if refresh_hits:
+            self._refresher = Thread(target=self._refresh, args=(refresh_hits,), daemon=True)
+            self._refresher.start()
 
     def append(self, videoid):
         logging.info("Added {} to streaming queue".format(videoid))
         super().append(videoid)
 
+    def resolve(self, videoid):
+        """
+        Resolves the video and audio stream URLs of videoid. Raises DownloadError on failure.
+        :return: (video URL, audio URL)
+        """
+        return self.extractor.resolve(videoid)
+
     def consume(self, videoid):
         """
         Overrides super method. Streams video videoid.
         """
-        stdout = subprocess.run(["youtube-dl", "-g", videoid], capture_output=True).stdout.decode("utf-8").split("\n")
-        if len(stdout) != 3:
-            self.plugin.report_error("youtube-dl -g failed on {}".format(videoid))
-            raise DownloadError
-        video, audio = stdout[:-1]
+        urls = self.resolved.get(videoid)
+        if urls is None:
+            try:
+                urls = self.resolve(videoid)
+            except DownloadError as e:
+                logging.warning(str(e))
+                if self.plugin:
+                    self.plugin.report_error(str(e))
+                return
+            self.resolved.put(videoid, urls)
+        else:
+            logging.debug("Using cached stream URLs for {}".format(videoid))
+
+        video, audio = urls
         video = StreamPlayer(video, plugin=self.plugin, videoid=videoid, name="Video")
         audio = StreamPlayer(audio, plugin=self.plugin, videoid=videoid, name="Audio")
         video.start()
         audio.start()
 
+    def stop(self):
+        """
+        Overrides super method; also stops refreshing stream URLs.
+        """
+        super().stop()
+        self._stop_refresh.set()
+
+    def _refresh(self, min_hits, interval=60):
+        while not self._stop_refresh.wait(interval):
+            for videoid in self.resolved.expiring(interval * 2, min_hits):
+                try:
+                    self.resolved.put(videoid, self.resolve(videoid))
+                    logging.debug("Refreshed stream URLs for {}".format(videoid))
+                except DownloadError as e:
+                    logging.info("Refreshing stream URLs failed ({})".format(e))
+
 
 class Downloader(Queue):
-    def __init__(self, videodir, player, plugin=None):
+    def __init__(self, videodir, player, plugin=None, cache=None, workers=None, prefetch_depth=None,
+                 rate_limit=DOWNLOAD_RATE_LIMIT, extractor=None, journal=None, capacity=QUEUE_CAPACITY):
         """
         Download handler. Use append() to request a download; calls player.append() on download success.
+        Downloads run on a pool of worker threads. A video that is already being downloaded is not downloaded
+        again, the request waits for the running download instead. Files are handed to the player in the
+        order they were requested.
+        Downloads are only started for the next prefetch_depth videos after the one that is playing;
+        prefetch() is to be called when the player finishes a video.
         :param videodir: Directory where the videos are to be stored
         :param player: Player object
         :param plugin: Plugin object to report errors to. Can be omitted.
+        :param cache: VideoCache object for videodir; created if omitted.
+        :param workers: Number of concurrent downloads; DOWNLOAD_WORKERS if omitted.
+        :param prefetch_depth: Look-ahead in the play queue; PREFETCH_DEPTH if omitted.
+        :param rate_limit: youtube-dl download rate limit, e.g. "2M"; None for no limit.
+        :param extractor: Extractor object; created from EXTRACTOR if omitted.
+        :param journal: util.Journal object to persist the queue. Can be omitted.
+        :param capacity: Maximum number of videos waiting for download or hand-off; None for no limit.
         """
         self.videodir = videodir
         if self.videodir.endswith("/"):
             self.videodir = self.videodir[:-1]
         self.player = player
         self.plugin = plugin
-        self.storage = []
+        self.cache = cache
+        if self.cache is None:
+            self.cache = VideoCache(self.videodir, WATCH_INTERVAL)
 
-        # mkdir videodir
-        if os.path.exists(self.videodir):
-            if not os.path.isdir(self.videodir):
-                raise NotADirectoryError(self.videodir)
-        else:
-            os.mkdir(self.videodir)
+        if workers is None:
+            workers = DOWNLOAD_WORKERS
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self.prefetch_depth = prefetch_depth
+        if self.prefetch_depth is None:
+            self.prefetch_depth = PREFETCH_DEPTH
+        self.rate_limit = rate_limit
+        self.extractor = extractor
+        if self.extractor is None:
+            self.extractor = make_extractor(EXTRACTOR)
+        self.inflight = {}  # videoid: Future of the running download
+        self.waiting = deque()  # (videoid, seq) outside the look-ahead window
+        self.pending = deque()  # (videoid, seq, future, attached) in request order
+        self.order_lock = Lock()
 
-        self.scan_storage()
-
-        super().__init__()
+        super().__init__(journal, capacity)
 
     def append(self, videoid):
         logging.info("Added {} to download queue".format(videoid))
@@ -161,59 +940,142 @@ class Downloader(Queue):
 
     def scan_storage(self):
         """
-        Scans videodir for video files; works like a download cache.
+        Rescans videodir for video files; works like a download cache.
         Video files are expected to be named videoid.ext with ext being the file extension.
         """
-        self.storage = []
-        for el in os.listdir(self.videodir):
-            file, ext = os.path.splitext(self.videodir + "/" + el)
-            _, file = os.path.split(file)
-            self.storage.append((file, ext))
+        self.cache.scan()
+
+    def backlog(self):
+        """
+        Overrides super method; includes the videos waiting for download or hand-off to the player.
+        """
+        return super().backlog() + len(self.waiting) + len(self.pending)
 
     def consume(self, videoid):
+        self.consume_item(None, videoid)
+
+    def consume_item(self, seq, videoid):
         """
         Overrides super method.
-        Downloads yt video videoid to videodir/videoid.ext. Raises DownloadError when youtube-dl fails.
+        Queues videoid for download; see prefetch(). It is marked as done in the journal once it was handed
+        to the player (or failed).
         :param videoid: yt id of the video to be downloaded
         """
-        found = False
-        for file, ext in self.storage:
-            if file == videoid:
-                found = True
-                break
+        with self.order_lock:
+            self.waiting.append((videoid, seq))
+        self.prefetch()
 
-        if not found:
-            logging.info("Downloading {}".format(videoid))
-            retval = os.system("youtube-dl {} -f bestvideo[ext=mp4]+bestaudio[ext=m4a] -o {}/%\(id\)s.%\(ext\)s"
-                               .format("https://youtube.com/watch?v=" + videoid, self.videodir))
-            if retval != 0:
-                msg = "youtube-dl failed on {}".format(videoid)
-                logging.warning(msg)
-                if self.plugin:
-                    self.plugin.report_error(msg)
-                return
-            self.scan_storage()
-
-        found = False
-        for file, ext in self.storage:
-            if file == videoid:
-                found = True
-                self.player.append(self.videodir + "/" + file + ext)
-        if not found:
+    def prefetch(self):
+        """
+        Starts downloads (or attaches to running ones) for waiting videos while fewer than prefetch_depth videos
+        are queued after the one that is playing.
+        """
+        started = []
+        with self.order_lock:
+            while not self.stopped and self.waiting \
+                    and len(self.pending) + self.player.backlog() <= self.prefetch_depth:
+                started.append(self._start(*self.waiting.popleft()))
+        for future in started:
+            future.add_done_callback(self._deliver)
+
+    def stop(self):
+        """
+        Overrides super method; no further downloads are started, running ones finish.
+        """
+        with self.order_lock:
+            super().stop()
+        self.workers.shutdown(wait=False)
+
+    def _start(self, videoid, seq):
+        """
+        Caller holds order_lock.
+        :return: Future for the path of the video file
+        """
+        path = self.cache.acquire(videoid)
+        if path is not None:
+            future = Future()
+            future.set_result(path)
+            attached = False
+        else:
+            future = self.inflight.get(videoid)
+            attached = future is not None
+            if future is None:
+                future = self.workers.submit(self.download, videoid)
+                self.inflight[videoid] = future
+            else:
+                logging.info("{} is already being downloaded".format(videoid))
+        self.pending.append((videoid, seq, future, attached))
+        return future
+
+    def download(self, videoid):
+        """
+        Runs fetch() on a worker thread and removes videoid from the in-flight table afterwards.
+        :return: path of the downloaded file; None on failure, including unexpected errors of fetch()
+        """
+        try:
+            return self.fetch(videoid)
+        except Exception as e:
+            msg = "download of {} failed: {}".format(videoid, e)
+            logging.exception(msg)
+            if self.plugin:
+                self.plugin.report_error(msg)
+            return None
+        finally:
+            with self.order_lock:
+                self.inflight.pop(videoid, None)
+
+    def fetch(self, videoid):
+        """
+        Downloads yt video videoid to videodir/videoid.ext.
+        :param videoid: yt id of the video to be downloaded
+        :return: path of the downloaded file (protected in the cache until it is played); None on failure
+        """
+        logging.info("Downloading {}".format(videoid))
+        try:
+            self.extractor.download(videoid, self.videodir, self.rate_limit)
+        except DownloadError as e:
+            msg = str(e)
+            logging.warning(msg)
+            if self.plugin:
+                self.plugin.report_error(msg)
+            return None
+
+        path = self.cache.add(videoid)
+        if path is None:
             msg = "file not found after download: {}".format(videoid)
             if self.plugin:
                 self.plugin.report_error(msg)
             logging.warning(msg)
-            return
+        return path
+
+    def _deliver(self, _=None):
+        """
+        Hands finished downloads to the player, stopping at the first request that is not finished yet.
+        """
+        with self.order_lock:
+            while self.pending and self.pending[0][2].done():
+                videoid, seq, future, attached = self.pending.popleft()
+                path = future.result()
+                if path is not None and attached:
+                    # the download was started by an earlier request; protect the file for this one as well
+                    path = self.cache.acquire(videoid)
+                if path is not None:
+                    self.player.append(path)
+                self.task_done(seq)
+        self.prefetch()
 
 
 class Player(Queue):
-    def __init__(self, plugin=None):
+    def __init__(self, plugin=None, cache=None, journal=None):
         """
         :param plugin: Plugin object to report errors to. Can be omitted.
+        :param cache: VideoCache the played files belong to; they are released after playback. Can be omitted.
+        :param journal: util.Journal object to persist the queue. Can be omitted.
         """
         self.plugin = plugin
-        super().__init__()
+        self.cache = cache
+        self.on_finished = None
+        super().__init__(journal)
 
     def consume(self, videofile):
         logging.info("Playing {}".format(videofile))
@@ -223,6 +1085,14 @@ class Player(Queue):
             logging.warning(msg)
             if self.plugin:
                 self.plugin.report_error(msg)
+        if self.cache is not None:
+            parsed = parse_filename(os.path.basename(videofile))
+            if parsed is not None:
+                self.cache.release(parsed[0], played=retval == 0)
+
+    def finished(self, videofile):
+        if self.on_finished is not None:
+            self.on_finished()
 
     def append(self, videofile):
         logging.info("Added {} to player queue".format(videofile))
@@ -241,6 +1111,7 @@ class LinkshareEndpoint(Endpoint):
         self.plugin = plugin
         self.mode = Mode.STREAM
         self.operator = self.streamer
+        self.expander = ThreadPoolExecutor(max_workers=1, thread_name_prefix="playlist")
         super().__init__(path)
 
     def do_GET(self, reqhandler):
@@ -265,6 +1136,24 @@ class LinkshareEndpoint(Endpoint):
                 reqhandler.wfile.write(found.encode("utf-8"))
                 return
 
+        # Queue depth and wait times
+        if route == ["queue"]:
+            stats = {
+                "downloader": self.downloader.stats(),
+                "streamer": self.streamer.stats(),
+                "player": self.downloader.player.stats(),
+            }
+            reqhandler.send_response(200)
+            reqhandler.send_header("Content-Type", "application/json")
+            reqhandler.end_headers()
+            reqhandler.wfile.write(json.dumps(stats).encode("utf-8"))
+            return
+
+        # Download cache
+        if route[0] == "cache":
+            self.cache_GET(reqhandler, route[1:])
+            return
+
         # Change mode
         if len(route) != 1 or route[0] not in ["download", "stream"]:
             reqhandler.send_response(400)  # Bad Request
@@ -287,6 +1176,28 @@ class LinkshareEndpoint(Endpoint):
             reqhandler.end_headers()
             return
 
+    def cache_GET(self, reqhandler, route):
+        cache = self.downloader.cache
+        if len(route) == 0:
+            reqhandler.send_response(200)
+            reqhandler.send_header("Content-Type", "application/json")
+            reqhandler.end_headers()
+            reqhandler.wfile.write(json.dumps(cache.stats()).encode("utf-8"))
+            return
+
+        if len(route) != 2 or route[0] not in ["pin", "unpin"] or not route[1]:
+            reqhandler.send_response(400)  # Bad Request
+            reqhandler.end_headers()
+            return
+        if route[0] == "pin":
+            logging.info("Pinning {}".format(route[1]))
+            cache.pin(route[1])
+        else:
+            logging.info("Unpinning {}".format(route[1]))
+            cache.unpin(route[1])
+        reqhandler.send_response(200)
+        reqhandler.end_headers()
+
     def do_POST(self, reqhandler):
         logging.debug("Incoming POST on {}".format(reqhandler.path))
         try:
@@ -305,6 +1216,12 @@ class LinkshareEndpoint(Endpoint):
             reqhandler.end_headers()
             return
 
+        if isinstance(data, dict) and "links" in data:
+            data = data["links"]
+        if isinstance(data, list):
+            self.bulk_POST(reqhandler, data)
+            return
+
         try:
             link = data["link"]
         except (KeyError, TypeError):
@@ -323,10 +1240,117 @@ class LinkshareEndpoint(Endpoint):
             reqhandler.send_response(422)  # Unprocessable entity
             reqhandler.end_headers()
             return
-        self.operator.append(link)
+        try:
+            self.operator.append(link)
+        except QueueFull:
+            logging.warning("Queue full, rejecting {}".format(link))
+            reqhandler.send_response(503)  # Service unavailable
+            reqhandler.send_header("Retry-After", str(QUEUE_RETRY_AFTER))
+            reqhandler.end_headers()
+            return
         reqhandler.send_response(202)  # Accepted
         reqhandler.end_headers()
 
+    def bulk_POST(self, reqhandler, links):
+        """
+        Queues the videos of links in one batch; playlists are expanded in the background.
+        """
+        operator = self.operator
+        results = []
+        videos = []  # (result, videoid)
+        playlists = []  # (result, listid)
+        for link in links:
+            result = {"link": link, "status": "invalid"}
+            results.append(result)
+            if not isinstance(link, str):
+                continue
+            try:
+                videos.append((result, parse_yt_url(link)))
+                continue
+            except ParseError:
+                pass
+            try:
+                playlists.append((result, parse_yt_playlist(link)))
+            except ParseError:
+                msg = "Unknown Youtube link: {}".format(link)
+                logging.warning(msg)
+                self.plugin.report_error(msg)
+
+        accepted = operator.extend(videoid for _, videoid in videos)
+        for i, (result, videoid) in enumerate(videos):
+            result["id"] = videoid
+            result["status"] = "queued" if i < accepted else "full"
+        full = operator.capacity is not None and operator.backlog() >= operator.capacity
+        for result, listid in playlists:
+            result["playlist"] = listid
+            if full:
+                result["status"] = "full"
+                continue
+            result["status"] = "expanding"
+            self.expander.submit(self.expand, listid, operator)
+
+        statuses = set(el["status"] for el in results)
+        headers = {}
+        if statuses & {"queued", "expanding"}:
+            code = 202  # Accepted
+        elif "full" in statuses:
+            code = 503  # Service unavailable
+            headers["Retry-After"] = str(QUEUE_RETRY_AFTER)
+        else:
+            code = 422  # Unprocessable entity
+        reqhandler.respond(code, json.dumps(results), "application/json", headers)
+
+    def expand(self, listid, operator):
+        """
+        Queues the videos of playlist listid on operator (the queue that was active when it was shared).
+        """
+        try:
+            videoids = operator.extractor.playlist(listid)[:PLAYLIST_MAX_ITEMS]
+        except Exception as e:
+            msg = "Unable to expand playlist {} ({})".format(listid, e)
+            logging.warning(msg)
+            self.plugin.report_error(msg)
+            return
+        accepted = operator.extend(videoids)
+        if accepted < len(videoids):
+            msg = "Queue full, dropped {} of {} videos of playlist {}".format(len(videoids) - accepted,
+                                                                                len(videoids), listid)
+            logging.warning(msg)
+            self.plugin.report_error(msg)
+
+
+def yt_url(videoid):
+    return "https://youtube.com/watch?v=" + videoid
+
+
+def parse_bytes(value):
+    """
+    Parses a youtube-dl style byte count, e.g. "50K" or "4.2M".
+    :return: number of bytes; None if value cannot be parsed
+    """
+    m = re.match(r"^(\d+(?:\.\d+)?)([kmgtKMGT]?)$", value.strip())
+    if m is None:
+        return None
+    return int(float(m.group(1)) * 1024 ** " kmgt".index(m.group(2).lower() or " "))
+
+
+def yt_playlist_url(listid):
+    return "https://youtube.com/playlist?list=" + listid
+
+
+def parse_yt_playlist(url):
+    """
+    Extracts the yt playlist id from url. Raises ParseError if url is no playlist link.
+    Currently supports:
+    [http[s]://][www.|m.]youtube.com/playlist?list=listid[&foo]
+    :param url: URL to be parsed
+    :return: playlist id
+    """
+    m = re.match(r"(https?://)?(www.)?(m.)?youtube.com/playlist\?(.*&)?list=(?P<listid>[^&/]+)", url.strip())
+    if m is None:
+        raise ParseError()
+    return m.group("listid")
+
 
 def parse_yt_url(url):
     """
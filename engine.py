@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Event
+
+
+###########
+# config ##
+IDLE_TIMEOUT = 10  # seconds the asyncio engine waits for a connected client to send its request
+#######
+
+
+class Engine:
+    """
+    Request serving strategy of a RESTServer. Subclasses decide where RequestHandler runs;
+    the handler and the Endpoint.do_GET/do_POST(reqhandler) contract stay the same for every engine.
+    """
+    name = None
+
+    def __init__(self, server, workers):
+        """
+        :param server: RESTServer object
+        :param workers: Maximum number of requests that are handled concurrently
+        """
+        self.server = server
+        self.workers = workers
+        self._running = False
+
+    def serve_forever(self, poll_interval=0.5):
+        self._running = True
+        try:
+            socketserver.BaseServer.serve_forever(self.server, poll_interval)
+        finally:
+            self._running = False
+
+    def process_request(self, request, client_address):
+        raise NotImplementedError()
+
+    def keepalive_capacity(self, connections):
+        """
+        :return: Number of connections that may stay open between requests. An open connection occupies
+                 a worker, so one worker is always left for new connections.
+        """
+        return max(0, min(connections, self.workers - 1))
+
+    def handle(self, request, client_address):
+        """
+        Runs the request handler on an accepted connection and closes it afterwards.
+        """
+        try:
+            self.server.finish_request(request, client_address)
+        except Exception:
+            self.server.handle_error(request, client_address)
+        finally:
+            self.server.shutdown_request(request)
+
+    def shutdown(self):
+        if self._running:
+            socketserver.BaseServer.shutdown(self.server)
+
+
+class SingleEngine(Engine):
+    """
+    Handles one request at a time in the serving thread (plain HTTPServer behaviour).
+    """
+    name = "single"
+
+    def keepalive_capacity(self, connections):
+        # an open connection would block the server
+        return 0
+
+    def process_request(self, request, client_address):
+        self.handle(request, client_address)
+
+
+class ThreadPoolEngine(Engine):
+    """
+    Hands every accepted connection to a bounded pool of worker threads.
+    If all workers are busy, the accept loop waits and new connections queue up in the listen backlog.
+    """
+    name = "threads"
+
+    def __init__(self, server, workers):
+        super().__init__(server, workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="request")
+        self._slots = BoundedSemaphore(workers)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._run, request, client_address)
+        except RuntimeError:
+            # executor already shut down
+            self._slots.release()
+            raise
+
+    def _run(self, request, client_address):
+        try:
+            self.handle(request, client_address)
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        super().shutdown()
+        self._executor.shutdown(wait=True)
+
+
+class AsyncioEngine(Engine):
+    """
+    Accepts connections on an asyncio event loop and waits there until the client has sent data,
+    so idle or slow clients do not occupy a worker. The (blocking) request handler then runs on a
+    bounded thread pool.
+    """
+    name = "asyncio"
+
+    def __init__(self, server, workers):
+        super().__init__(server, workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="request")
+        self._loop = None
+        self._task = None
+        self._tasks = set()
+        self._stopped = Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._stopped.clear()
+        self._running = True
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._running = False
+            self._stopped.set()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        slots = asyncio.Semaphore(self.workers)
+        sock = self.server.socket
+        sock.setblocking(False)
+        try:
+            while True:
+                request, client_address = await self._loop.sock_accept(sock)
+                if not self.server.verify_request(request, client_address):
+                    self.server.shutdown_request(request)
+                    continue
+                task = self._loop.create_task(self._dispatch(slots, request, client_address))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except asyncio.CancelledError:
+            logging.debug("asyncio engine stopped")
+        finally:
+            sock.setblocking(True)
+
+    async def _dispatch(self, slots, request, client_address):
+        handed_off = False
+        try:
+            await asyncio.wait_for(self._readable(request), IDLE_TIMEOUT)
+            async with slots:
+                handed_off = True
+                await self._loop.run_in_executor(self._executor, self._run, request, client_address)
+        except asyncio.TimeoutError:
+            logging.debug("No request from {} within {}s, closing".format(client_address, IDLE_TIMEOUT))
+        finally:
+            if not handed_off:
+                self.server.shutdown_request(request)
+
+    async def _readable(self, request):
+        fut = self._loop.create_future()
+
+        def ready():
+            if not fut.done():
+                fut.set_result(None)
+
+        self._loop.add_reader(request.fileno(), ready)
+        try:
+            await fut
+        finally:
+            self._loop.remove_reader(request.fileno())
+
+    def _run(self, request, client_address):
+        request.setblocking(True)
+        self.handle(request, client_address)
+
+    def process_request(self, request, client_address):
+        # only used if the socketserver loop is driven directly (handle_request)
+        self._run(request, client_address)
+
+    def shutdown(self):
+        if self._running and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+            self._stopped.wait()
+        self._executor.shutdown(wait=True)
+
+
+ENGINES = {
+    SingleEngine.name: SingleEngine,
+    ThreadPoolEngine.name: ThreadPoolEngine,
+    AsyncioEngine.name: AsyncioEngine,
+}
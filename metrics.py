@@ -0,0 +1,136 @@
+from threading import Lock
+from bisect import bisect_left
+import logging
+
+
+############
+# config ###
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+############
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. observe() costs one bisect and two additions; buckets are
+    made cumulative when rendered.
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, number of observations <= upper bound), the last bound being "+Inf"
+        """
+        r = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            r.append((bound, total))
+        return r
+
+
+class Metrics:
+    """
+    Request metrics of the server plus metric families collected from plugins,
+    rendered in the Prometheus text exposition format.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._requests = {}  # (endpoint, method, status): count
+        self._latency = {}  # (endpoint, method): Histogram
+        self._collectors = []
+        self._lock = Lock()
+
+    def observe_request(self, endpoint, method, status, seconds):
+        """
+        :param endpoint: Endpoint path; None if no endpoint matched
+        :param status: Response status code; None if no response was sent
+        :param seconds: Time spent handling the request
+        """
+        endpoint = endpoint or "none"
+        status = str(status) if status is not None else "none"
+        with self._lock:
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._latency.get((endpoint, method))
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self._latency[(endpoint, method)] = histogram
+            histogram.observe(seconds)
+
+    def add_collector(self, collector):
+        """
+        Registers a function that is called on every render().
+        It returns an iterable of metric families (name, type, help, samples),
+        samples being a list of (labels dict, value).
+        """
+        self._collectors = self._collectors + [collector]  # replaced, not changed, while render() may iterate it
+
+    def remove_collector(self, collector):
+        """
+        Unregisters a function registered with add_collector(), e.g. when its plugin is shut down.
+        """
+        self._collectors = [el for el in self._collectors if el != collector]
+
+    def render(self):
+        lines = []
+        with self._lock:
+            requests = sorted(self._requests.items())
+            latency = sorted((key, histogram.cumulative(), histogram.sum, histogram.count)
+                             for key, histogram in self._latency.items())
+
+        lines.append("# HELP http_requests_total Requests by endpoint, method and response status.")
+        lines.append("# TYPE http_requests_total counter")
+        for (endpoint, method, status), count in requests:
+            labels = format_labels({"endpoint": endpoint, "method": method, "status": status})
+            lines.append("http_requests_total{} {}".format(labels, count))
+
+        lines.append("# HELP http_request_duration_seconds Request handling time by endpoint and method.")
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        for (endpoint, method), buckets, total, count in latency:
+            labels = {"endpoint": endpoint, "method": method}
+            for bound, n in buckets:
+                lines.append("http_request_duration_seconds_bucket{} {}".format(
+                    format_labels(dict(labels, le=str(bound))), n))
+            lines.append("http_request_duration_seconds_sum{} {}".format(format_labels(labels), total))
+            lines.append("http_request_duration_seconds_count{} {}".format(format_labels(labels), count))
+
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                logging.error("Metrics collector {} failed ({})".format(collector, e))
+                continue
+            for name, kind, helptext, samples in families:
+                lines.append("# HELP {} {}".format(name, helptext))
+                lines.append("# TYPE {} {}".format(name, kind))
+                for labels, value in samples:
+                    lines.append("{}{} {}".format(name, format_labels(labels), format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, escape(str(value))) for key, value in labels.items()) + "}"
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    return str(value)
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,101 @@
+from threading import Lock
+import cProfile
+import pstats
+import marshal
+import io
+
+
+class Profiler:
+    """
+    Profiles the next N requests (optionally only those to one endpoint) with cProfile and aggregates the stats.
+    While no run is started, the request path only checks self.remaining.
+    cProfile can only profile one thread at a time, so concurrent requests are not profiled
+    and do not count as samples.
+    """
+    def __init__(self):
+        self.remaining = 0
+        self.path = None
+        self.profiled = 0
+        self._stats = None
+        self._lock = Lock()
+        self._running = Lock()
+
+    def start(self, samples, path=None):
+        """
+        Discards the previous stats and profiles the next samples requests.
+        :param path: Endpoint path; only requests to the endpoint at this path are profiled. All requests if omitted.
+                     A path rather than the endpoint object, which is replaced when a plugin is loaded or reloaded.
+        """
+        with self._lock:
+            self.path = path
+            self.profiled = 0
+            self._stats = None
+            self.remaining = samples
+
+    def stop(self):
+        with self._lock:
+            self.remaining = 0
+
+    def claim(self, endpoint):
+        """
+        :return: True if the request to endpoint is to be profiled; then release() has to be called afterwards
+        """
+        with self._lock:
+            if self.remaining <= 0 or (self.path is not None and endpoint.path != self.path):
+                return False
+            if not self._running.acquire(blocking=False):
+                return False
+            self.remaining -= 1
+            return True
+
+    def run(self, func, *args):
+        """
+        Calls func(*args) under the profiler. The caller has claimed the sample.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+        finally:
+            self._running.release()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self.profiled += 1
+
+    def has_stats(self):
+        return self._stats is not None
+
+    def status(self):
+        with self._lock:
+            return {
+                "endpoint": self.path,
+                "remaining": self.remaining,
+                "profiled": self.profiled,
+            }
+
+    def report(self, sort="cumulative", limit=50):
+        """
+        :return: pstats text report of the aggregated stats
+        """
+        stream = io.StringIO()
+        with self._lock:
+            if self._stats is None:
+                return ""
+            self._stats.stream = stream
+            self._stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def dump(self):
+        """
+        :return: aggregated stats in the format of pstats.Stats.dump_stats(), to be loaded with pstats.Stats(file)
+        """
+        with self._lock:
+            if self._stats is None:
+                return b""
+            return marshal.dumps(self._stats.stats)
@@ -0,0 +1,132 @@
+class _Node:
+    __slots__ = ("children", "endpoint")
+
+    def __init__(self):
+        self.children = {}
+        self.endpoint = None
+
+
+class RouteIndex:
+    """
+    Prefix trie over endpoint path segments; "/a/b" is stored as root -> "a" -> "b".
+    Endpoints are added at registration time, lookups cost O(path depth) regardless of
+    the number of registered endpoints.
+    """
+    def __init__(self, case_sensitive=False, ignore_double_slash=False):
+        """
+        :param case_sensitive: If False, "/A/b" and "/a/B" are the same route.
+        :param ignore_double_slash: If True, empty path segments are skipped ("/a//b" is "/a/b").
+        """
+        self.case_sensitive = case_sensitive
+        self.ignore_double_slash = ignore_double_slash
+        self._root = _Node()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _key(self, segment):
+        if self.case_sensitive:
+            return segment
+        return segment.lower()
+
+    def _segments(self, pathlist):
+        for segment in pathlist:
+            if segment == "" and self.ignore_double_slash:
+                continue
+            yield self._key(segment)
+
+    def _node(self, endpoint, create=False):
+        node = self._root
+        for segment in self._segments(endpoint.pathlist[1:]):
+            child = node.children.get(segment)
+            if child is None:
+                if not create:
+                    return None
+                child = _Node()
+                node.children[segment] = child
+            node = child
+        return node
+
+    def add(self, endpoint):
+        """
+        Adds endpoint to the index.
+        :param endpoint: Endpoint object
+        :return: False if another endpoint is already registered on the same path, True otherwise
+        """
+        node = self._node(endpoint, create=True)
+        if node.endpoint is not None:
+            return False
+        node.endpoint = endpoint
+        self._size += 1
+        return True
+
+    def remove(self, endpoint):
+        """
+        Removes endpoint from the index. Empty branches are left in place.
+        :param endpoint: Endpoint object
+        :return: True if endpoint was found and removed
+        """
+        node = self._node(endpoint)
+        if node is None or node.endpoint is not endpoint:
+            return False
+        node.endpoint = None
+        self._size -= 1
+        return True
+
+    def find(self, endpoint):
+        """
+        :return: the endpoint registered on the same path as endpoint; None if there is none
+        """
+        node = self._node(endpoint)
+        if node is None:
+            return None
+        return node.endpoint
+
+    def replace(self, old, new):
+        """
+        Registers new in place of old, which has the same path. Lookups see either old or new, never neither.
+        :return: True if old was found and replaced
+        """
+        node = self._node(old)
+        if node is None or node.endpoint is not old or self._node(new) is not node:
+            return False
+        node.endpoint = new
+        return True
+
+    def lookup(self, path):
+        """
+        Finds the endpoint with the longest path that is a prefix of path (segment-wise).
+        :param path: request path, e.g. "/a/b/c"
+        :return: (endpoint, route) with route being the part of path after the endpoint path;
+                 (None, None) if no endpoint matches
+        """
+        if not path.startswith("/"):
+            path = "/" + path
+
+        node = self._root
+        best = node.endpoint
+        best_end = 0
+
+        # pos: index of the "/" that starts the current segment
+        pos = 0
+        length = len(path)
+        while pos < length:
+            end = path.find("/", pos + 1)
+            if end == -1:
+                end = length
+            segment = path[pos + 1:end]
+            if segment == "" and self.ignore_double_slash:
+                pos = end
+                continue
+            node = node.children.get(self._key(segment))
+            if node is None:
+                break
+            if node.endpoint is not None:
+                best = node.endpoint
+                best_end = end
+            pos = end
+
+        if best is None:
+            return None, None
+        return best, path[best_end:]
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from threading import Lock
+from threading import Lock, RLock, Condition
+from collections import OrderedDict
 from datetime import datetime
-from util import Stack
+from engine import ENGINES
+from routing import RouteIndex
+from metrics import Metrics
+from profiling import Profiler
+from urllib.parse import parse_qs
+import http.client
 import pkgutil
+import importlib
+import io
 import sys
 import logging
 import json
+import time
 
 
 ############
@@ -15,10 +24,17 @@ import json
 PORT = 8080
 DEBUG = False
 PLUGINDIR = "endpoints"
+MANIFEST = None  # JSON file {"<plugin module>": ["<endpoint path>", ...]}; listed plugins are loaded on first request
+ENGINE = "threads"  # out of [single, threads, asyncio]
+WORKERS = 4  # requests handled concurrently by the threads and asyncio engines
+ERROR_CAPACITY = 256  # distinct errors kept in memory; the least recently reported ones are evicted
+KEEPALIVE_CONNECTIONS = 2  # connections kept open between requests; capped at WORKERS - 1, 0 disables
+KEEPALIVE_TIMEOUT = 5  # seconds an open connection may stay idle before it is closed
+RELOAD_DRAIN_TIMEOUT = 30  # seconds a plugin reload waits for running requests on the old endpoints
 
 # Endpoint URL options
-IGNORE_DOUBLE_SLASH = False  # not implemented yet
-CASE_SENSITIVE = False  # not implemented yet
+IGNORE_DOUBLE_SLASH = False
+CASE_SENSITIVE = False
 ############
 ############
 
@@ -27,6 +43,10 @@ usage = "Usage: {} [OPTIONS]\n\n" \
         "  --help\n" \
         "  --port PORT\n" \
         "  --debug\n" \
+        "  --engine [single|threads|asyncio]\n" \
+        "  --workers WORKERS\n" \
+        "  --manifest MANIFESTFILE\n" \
+        "  --startup-report\n" \
         "  --yttest YOUTUBELINK\n" \
         "".format(sys.argv[0])
 
@@ -39,25 +59,121 @@ class MethodError(Exception):
     pass
 
 
+class PluginError(Exception):
+    pass
+
+
 class Error:
+    """
+    Error record. Repeated errors with the same plugin and message are coalesced into one record
+    (see ErrorStore); timestamps are integer unix times.
+    """
+    __slots__ = ("plugin", "msg", "first_seen", "last_seen", "count", "seq")
+
     def __init__(self, plugin, msg, ts=None):
         self.msg = msg
-        self.plugin = plugin
-        self.timestamp = None
+        self.plugin = getattr(plugin, "name", None) or getattr(plugin, "path", None) or str(plugin)
         if ts is None:
-            self.timestamp = datetime.now()
+            ts = time.time()
+        elif isinstance(ts, datetime):
+            ts = ts.timestamp()
+        self.first_seen = int(ts)
+        self.last_seen = self.first_seen
+        self.count = 1
+        self.seq = None
+
+    @property
+    def key(self):
+        return self.plugin, self.msg
 
     def serializable(self):
         return {
-            "plugin": self.plugin.name,
+            "seq": self.seq,
+            "plugin": self.plugin,
             "msg": self.msg,
-            "timestamp": self.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": format_timestamp(self.last_seen),
+            "first_seen": format_timestamp(self.first_seen),
+            "count": self.count,
         }
 
     def to_json(self):
         return json.dumps(self.serializable())
 
 
+class ErrorStore:
+    """
+    Bounded error store. Errors with the same plugin and message are coalesced into one record.
+    Every report moves its record to the newest position and gives it a new sequence number,
+    so readers with a cursor (since=seq) see recurring errors again without the store growing.
+    If the store is full, the record that was reported least recently is evicted.
+    """
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1.")
+        self.capacity = capacity
+        self.evicted = 0
+        self.coalesced = 0
+        self._records = OrderedDict()
+        self._next = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def is_empty(self):
+        return not self._records
+
+    @property
+    def next_seq(self):
+        return self._next
+
+    def push(self, error):
+        """
+        :param error: Error object
+        :return: sequence number of the (possibly coalesced) record
+        """
+        with self._lock:
+            record = self._records.get(error.key)
+            if record is None:
+                record = error
+                self._records[error.key] = record
+                if len(self._records) > self.capacity:
+                    self._records.popitem(last=False)
+                    self.evicted += 1
+            else:
+                record.count += error.count
+                record.first_seen = min(record.first_seen, error.first_seen)
+                record.last_seen = max(record.last_seen, error.last_seen)
+                self._records.move_to_end(error.key)
+                self.coalesced += 1
+            record.seq = self._next
+            self._next += 1
+            return record.seq
+
+    def top(self):
+        with self._lock:
+            if not self._records:
+                raise IndexError("Error store is empty.")
+            return next(reversed(self._records.values()))
+
+    def read(self, since=-1, limit=None):
+        """
+        :param since: Only records with a sequence number greater than since are returned.
+        :param limit: Maximum number of records to return (oldest first).
+        :return: List of (seq, error) tuples, oldest first
+        """
+        r = []
+        with self._lock:
+            for record in reversed(self._records.values()):
+                if record.seq <= since:
+                    break
+                r.append((record.seq, record))
+        r.reverse()
+        if limit is not None:
+            r = r[:limit]
+        return r
+
+
 class Endpoint:
     """
     Endpoint to be subclassed and registered with the server.
@@ -66,65 +182,342 @@ class Endpoint:
     do_POST(requesthandler),
     do_HEAD(requesthandler),
     do_PUT(requesthandler)
-    If a method is not present, the request is refused (TODO 403 or 404 maybe).
+    If a method is not present, the request is refused with 405.
     """
+    retired = False  # set when the endpoint is replaced by a plugin reload; it gets no new requests then
+
     def __init__(self, path):
         self.path = sanitize_path(path)
         self.pathlist = self.path.split("/")  # todo property structure
 
 
+class LazyEndpoint(Endpoint):
+    """
+    Placeholder for an endpoint of a plugin that is loaded on the first request to it (see MANIFEST).
+    """
+    def __init__(self, path, module):
+        self.module = module
+        self.loaded = False
+        super().__init__(path)
+
+
 class RESTServer(HTTPServer):
+    request_queue_size = 64  # listen backlog; connections wait here while all workers are busy
+
     def __init__(self, config, **kwargs):
         addr = ("", config["port"])
         super().__init__(addr, RequestHandler, **kwargs)
+        self.engine = ENGINES[config.get("engine", ENGINE)](self, config.get("workers", WORKERS))
+        self.keepalive_timeout = config.get("keepalive_timeout", KEEPALIVE_TIMEOUT)
+        self.keepalive_max = self.engine.keepalive_capacity(config.get("keepalive", KEEPALIVE_CONNECTIONS))
+        self._keepalive = 0
+        self._keepalive_lock = Lock()
+
+        self._endpoints_to_register = None
+        self._errors = ErrorStore(config.get("error_capacity", ERROR_CAPACITY))
+        self.metrics = Metrics()
+        self.profiler = Profiler()
 
         self.endpoints = []
+        self.routes = RouteIndex(case_sensitive=CASE_SENSITIVE, ignore_double_slash=IGNORE_DOUBLE_SLASH)
         self.plugins = []
+        self.plugindir = config.get("plugindir", PLUGINDIR)
+        self.manifest = config.get("manifest", MANIFEST)
+        self.startup = OrderedDict()  # plugin module: {"import": seconds, "init": seconds, "lazy": bool}
+        self._loaded = {}  # plugin module: plugin object
+        self._load_lock = RLock()
+        self._reloaded = Condition(self._load_lock)  # notified when a plugin reload finished
+        self._reloading = set()  # plugin modules whose reload is waiting for running requests
+        self._inflight = {}  # endpoint: number of requests it is handling
+        self._inflight_cond = Condition()
         self.load_plugins()
 
-        self._endpoints_to_register = None
-        self._errors = Stack()
-        self._error_lock = Lock()
-
-        logging.info("Running server.")
+    def run(self):
+        logging.info("Running server ({} engine).".format(self.engine.name))
         try:
             self.serve_forever()
         except KeyboardInterrupt:
             self.shutdown()
 
+    def serve_forever(self, poll_interval=0.5):
+        self.engine.serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        self.engine.process_request(request, client_address)
+
     def load_plugins(self):
+        """
+        Imports and initializes the plugins in plugindir. Plugins listed in the manifest only get placeholder
+        endpoints; they are loaded on the first request to one of them (see load_lazy()).
+        """
+        if not self.plugindir:
+            return
+
+        manifest = self.read_manifest()
         # import
-        for el in pkgutil.iter_modules([PLUGINDIR]):
-            plugin = el[1]
-            try:
-                p = pkgutil.importlib.import_module("{}.{}".format(PLUGINDIR, plugin))
-            except Exception as e:
-                logging.error("Unable to load plugin: {} ({})".format(plugin, e))
+        modules = []
+        for el in pkgutil.iter_modules([self.plugindir]):
+            name = el[1]
+            if name in manifest:
+                self.startup[name] = {"import": None, "init": None, "lazy": True}
+                for path in manifest[name]:
+                    self._add_endpoint(LazyEndpoint(path, name), None)
                 continue
-            else:
-                self.plugins.append(p)
+            module = self._import_plugin(name)
+            if module is not None:
+                modules.append((name, module))
 
         # load
-        failed = []
-        for i in range(len(self.plugins)):
-            module = self.plugins[i]
-            try:
-                self._endpoints_to_register = []
-                plugin = module.Plugin(self)
-                logging.info("Loaded Plugin: {}".format(plugin.name))
-            except (AttributeError, TypeError, Exception) as e:
-                failed.append(module)
-                logging.error("Unable to load plugin: {} ({})".format(module, e))
-                continue
+        for name, module in modules:
+            self._init_plugin(name, module)
 
-            self.plugins[i] = plugin
-            for endpoint in self._endpoints_to_register:
-                self.endpoints.append((endpoint, plugin))
-                logging.info("Registered endpoint: {}".format(endpoint.path))
+    def read_manifest(self):
+        """
+        :return: dict plugin module: list of endpoint paths; empty if there is no (valid) manifest
+        """
+        if not self.manifest:
+            return {}
+        try:
+            with open(self.manifest) as f:
+                manifest = json.load(f)
+            if not isinstance(manifest, dict) or \
+                    not all(isinstance(el, list) and all(isinstance(p, str) for p in el) for el in manifest.values()):
+                raise ValueError("expected {\"<plugin>\": [\"<path>\", ...]}")
+        except (OSError, ValueError) as e:
+            logging.error("Unable to read manifest {}, loading all plugins ({})".format(self.manifest, e))
+            return {}
+        return manifest
+
+    def _import_plugin(self, name):
+        start = time.perf_counter()
+        try:
+            module = pkgutil.importlib.import_module("{}.{}".format(self.plugindir, name))
+        except Exception as e:
+            logging.error("Unable to load plugin: {} ({})".format(name, e))
+            return None
+        self.startup.setdefault(name, {"import": None, "init": None, "lazy": False})
+        self.startup[name]["import"] = time.perf_counter() - start
+        return module
+
+    def _init_plugin(self, name, module):
+        start = time.perf_counter()
+        try:
+            self._endpoints_to_register = []
+            plugin = module.Plugin(self)
+            logging.info("Loaded Plugin: {}".format(plugin.name))
+        except (AttributeError, TypeError, Exception) as e:
             self._endpoints_to_register = None
+            logging.error("Unable to load plugin: {} ({})".format(module, e))
+            return None
+        self.startup[name]["init"] = time.perf_counter() - start
+
+        self.plugins.append(plugin)
+        self._loaded[name] = plugin
+        for endpoint in self._endpoints_to_register:
+            self._add_endpoint(endpoint, plugin)
+        self._endpoints_to_register = None
+        return plugin
+
+    def load_lazy(self, placeholder):
+        """
+        Imports and initializes the plugin of placeholder (a LazyEndpoint) unless that already happened.
+        Its endpoints take the place of its placeholders; placeholders it does not replace are removed.
+        """
+        with self._load_lock:
+            # placeholders of a reload are replaced by reload_plugin()
+            self._reloaded.wait_for(lambda: placeholder.module not in self._reloading)
+            if placeholder.loaded:
+                return
+            name = placeholder.module
+            placeholders = [el for el, _ in self.endpoints if isinstance(el, LazyEndpoint) and el.module == name]
+            module = self._import_plugin(name)
+            plugin = None
+            if module is not None:
+                plugin = self._init_plugin(name, module)
+            if plugin is None:
+                self.report_error(name, "Unable to load plugin on request to {}".format(placeholder.path))
+            else:
+                times = self.startup[name]
+                logging.info("Loaded plugin {} on demand in {:.3f}s".format(name, times["import"] + times["init"]))
+
+            for path in self._remove_placeholders(placeholders):
+                if plugin is not None:
+                    logging.warning("Plugin {} did not register {} from the manifest".format(name, path))
+
+    def _remove_placeholders(self, placeholders):
+        """
+        Marks placeholders as loaded and removes them; the caller holds _load_lock.
+        :return: paths of the placeholders that were still routed, i.e. not replaced by an endpoint of the plugin
+        """
+        r = []
+        for el in placeholders:
+            el.loaded = True
+            if self.routes.remove(el):
+                r.append(el.path)
+            self.endpoints = [(ep, p) for ep, p in self.endpoints if ep is not el]
+        return r
 
-        for el in failed:
-            self.plugins.remove(el)
+    def reload_plugin(self, name, caller=None, timeout=RELOAD_DRAIN_TIMEOUT, enclosing=()):
+        """
+        Re-imports the plugin module name and replaces the running plugin with a new instance without
+        closing the listening socket. Requests to the plugin's endpoints that arrive meanwhile wait and are
+        handled by the new endpoints; requests already running on the old endpoints are allowed to finish
+        (up to timeout seconds) before the old plugin is shut down and the new one initialized.
+        A plugin that is not loaded (lazy, or its initialization failed) is imported afresh and initialized.
+        If the new version fails to initialize, the plugin's endpoints stay placeholders, so the next request
+        to one of them or the next reload tries again.
+        Raises PluginError if the plugin is unknown or the new version fails to import or initialize.
+        :param caller: Endpoint handling the reload request; its own request is not waited for
+        :param enclosing: Endpoints of the requests the reload request was dispatched from (see
+                          RequestHandler.enclosing()); the plugin of one of them cannot be reloaded, its
+                          request would never finish
+        :return: new plugin object
+        """
+        with self._load_lock:
+            if name not in self.startup:
+                raise PluginError("Plugin {} is unknown".format(name))
+            old = self._loaded.get(name)
+            if name in self._reloading:
+                raise PluginError("Plugin {} is already being reloaded".format(name))
+            if old is not None and any(p is old and ep in enclosing for ep, p in self.endpoints):
+                raise PluginError("Plugin {} is handling the request that reloads it".format(name))
+
+            # a fresh module object; the old plugin keeps running on the old module's globals until it is shut down
+            start = time.perf_counter()
+            modname = "{}.{}".format(self.plugindir, name)
+            old_module = sys.modules.pop(modname, None)
+            importlib.invalidate_caches()
+            try:
+                module = importlib.import_module(modname)
+            except Exception as e:
+                sys.modules[modname] = old_module
+                raise PluginError("Unable to re-import plugin {} ({})".format(name, e))
+            self.startup[name]["import"] = time.perf_counter() - start
+
+            if old is None:
+                # nothing to drain; requests to placeholders wait in load_lazy() for _load_lock
+                placeholders = [el for el, _ in self.endpoints if isinstance(el, LazyEndpoint) and el.module == name]
+                plugin = self._init_plugin(name, module)
+                if plugin is None:
+                    raise PluginError("Unable to initialize plugin {}".format(name))
+                self._remove_placeholders(placeholders)
+                logging.info("Loaded plugin {} in {:.3f}s".format(name, time.perf_counter() - start))
+                return plugin
+
+            # new requests wait in load_lazy() until the new endpoints are in place
+            old_endpoints = [ep for ep, p in self.endpoints if p is old]
+            placeholders = []
+            for ep in old_endpoints:
+                placeholder = LazyEndpoint(ep.path, name)
+                if self.routes.replace(ep, placeholder):
+                    placeholders.append(placeholder)
+            self.endpoints = [(ep, p) for ep, p in self.endpoints if p is not old] + \
+                [(el, None) for el in placeholders]
+            self._reloading.add(name)
+
+        def drained():
+            return all(self._inflight.get(ep, 0) <= (1 if ep is caller else 0) for ep in old_endpoints)
+
+        # without _load_lock, so running requests can still load other plugins meanwhile
+        with self._inflight_cond:
+            for ep in old_endpoints:
+                ep.retired = True
+            if not self._inflight_cond.wait_for(drained, timeout):
+                logging.warning("Requests to plugin {} still running after {}s, reloading anyway".format(
+                    name, timeout))
+
+        with self._load_lock:
+            try:
+                self._shutdown_plugin(old)
+                self.plugins.remove(old)
+                del self._loaded[name]
+                plugin = self._init_plugin(name, module)
+                # on failure the placeholders stay; waiting requests load the plugin again in load_lazy()
+                if plugin is not None:
+                    self._remove_placeholders(placeholders)
+            finally:
+                self._reloading.discard(name)
+                self._reloaded.notify_all()
+            if plugin is None:
+                raise PluginError("Unable to initialize plugin {}".format(name))
+            logging.info("Reloaded plugin {} in {:.3f}s".format(name, time.perf_counter() - start))
+            return plugin
+
+    def dispatch_internal(self, method, path, body=b"", headers=None, client_address=("internal", 0),
+                          parent=None):
+        """
+        Handles a request without a connection: routed with match_route() and passed to the endpoint like a
+        request from a client.
+        :param body: request body (bytes)
+        :param headers: dict of request headers (str, latin-1); Content-Length is set from body, a given one is ignored
+        :param parent: RequestHandler of the request this one is dispatched from
+        :return: (status, HTTPMessage headers, body bytes); status 500 if the endpoint failed or sent nothing
+        """
+        request = None
+        try:
+            request = InternalRequest(self, method, path, body, headers, client_address, parent)
+            request.do_method(method)
+            return request.response()
+        except Exception as e:
+            logging.error("Internal {} on {} failed ({})".format(method, path, e))
+            return getattr(request, "status", None) or 500, http.client.HTTPMessage(), b""
+
+    def plugin_info(self):
+        """
+        :return: list of dicts with module, name, lazy, loaded and endpoint paths of every plugin
+        """
+        with self._load_lock:
+            r = []
+            for name, times in self.startup.items():
+                plugin = self._loaded.get(name)
+                r.append({
+                    "module": name,
+                    "name": getattr(plugin, "name", None),
+                    "lazy": times["lazy"],
+                    "loaded": plugin is not None,
+                    "endpoints": [ep.path for ep, p in self.endpoints
+                                  if (plugin is not None and p is plugin) or getattr(ep, "module", None) == name],
+                })
+            return r
+
+    def enter(self, endpoint):
+        """
+        Counts a request to endpoint as running.
+        :return: False if endpoint is retired; the request has to be routed again
+        """
+        with self._inflight_cond:
+            if endpoint.retired:
+                return False
+            self._inflight[endpoint] = self._inflight.get(endpoint, 0) + 1
+            return True
+
+    def leave(self, endpoint):
+        with self._inflight_cond:
+            count = self._inflight.pop(endpoint) - 1
+            if count:
+                self._inflight[endpoint] = count
+            if endpoint.retired:
+                self._inflight_cond.notify_all()
+
+    def startup_report(self):
+        """
+        :return: text table with import and init time per plugin
+        """
+        def ms(seconds):
+            return "-" if seconds is None else "{:.1f}".format(seconds * 1000)
+
+        lines = ["{:<16} {:>10} {:>10}".format("plugin", "import ms", "init ms")]
+        total = 0
+        for name, times in self.startup.items():
+            note = ""
+            if times["lazy"]:
+                note = "lazy, loaded" if times["init"] is not None else "lazy, not loaded"
+            elif times["init"] is None:
+                note = "failed"
+            total += (times["import"] or 0) + (times["init"] or 0)
+            lines.append("{:<16} {:>10} {:>10}  {}".format(name, ms(times["import"]), ms(times["init"]), note).rstrip())
+        lines.append("{:<16} {:>21}".format("total", ms(total)))
+        return "\n".join(lines)
 
     def match_endpoints(self, path):
         """
@@ -133,123 +526,164 @@ class RESTServer(HTTPServer):
         :param path: path that is to be matched
         :return: endpoint object that matches; None if no match is found
         """
-        path = sanitize_path(path).split("/")
-        candidates = []
-        for el in self.endpoints:
-            candidates.append(el[0])
-        matches = []
-        todel = []
-
-        # comparison loop
-        for i in range(len(path)):
-            if not candidates:
-                break
-            for el in candidates:
-                if len(el.pathlist) == i:
-                    matches.append(el)
-                    todel.append(el)
-                elif el.pathlist[i] != path[i]:
-                    todel.append(el)
-                elif i == len(el.pathlist) - 1:
-                    matches.append(el)
-
-            for el in todel:
-                candidates.remove(el)
-            todel = []
-
-        if not matches:
-            return None
+        return self.routes.lookup(path)[0]
 
-        # get best match
-        best = matches[0]
-        for el in matches:
-            if len(el.pathlist) > len(best.pathlist):
-                best = el
-        return best
+    def match_route(self, path):
+        """
+        Like match_endpoints, but also returns the remainder of path after the endpoint path.
+        :param path: path that is to be matched
+        :return: (endpoint, route); (None, None) if no match is found
+        """
+        return self.routes.lookup(path)
 
     def register_endpoint(self, endpoint):
         """
-        Registers and endpoint.
+        Registers an endpoint. Endpoints registered in a Plugin constructor are associated with that plugin.
         :param endpoint: Endpoint object
         """
         if self._endpoints_to_register is None:
-            logging.error("Endpoints must be registered in the Plugin constructor ({})".format(endpoint.path))
+            self._add_endpoint(endpoint, None)
             return
-        if endpoint not in self.endpoints and endpoint not in self._endpoints_to_register:
+        if endpoint not in self._endpoints_to_register:
             self._endpoints_to_register.append(endpoint)
         else:
             logging.error("Endpoint already registered: {}".format(endpoint.path))
 
+    def _add_endpoint(self, endpoint, plugin):
+        existing = self.routes.find(endpoint)
+        if isinstance(existing, LazyEndpoint) and plugin is not None and self.routes.replace(existing, endpoint):
+            existing.loaded = True
+            self.endpoints = [(ep, p) for ep, p in self.endpoints if ep is not existing]
+        elif not self.routes.add(endpoint):
+            logging.error("Endpoint already registered: {}".format(endpoint.path))
+            return
+        self.endpoints.append((endpoint, plugin))
+        logging.info("Registered endpoint: {}".format(endpoint.path))
+
     def report_error(self, endpoint, msg, timestamp=None):
         """
-        Reports an error to the server error stack.
-        :param endpoint: Endpoint object the error occured in.
+        Reports an error to the server error store. Repeated errors (same plugin and message) are coalesced.
+        :param endpoint: Plugin or Endpoint object the error occured in.
         :param msg: Error message.
-        :param timestamp: Error timestamp; uses now if ommited.
-        :return:
+        :param timestamp: Error timestamp (unix time or datetime); uses now if ommited.
+        :return: Sequence number of the error
         """
-        error = Error(endpoint, msg, timestamp)
-        self._error_lock.acquire()
-        self._errors.push(error)
-        self._error_lock.release()
+        return self._errors.push(Error(endpoint, msg, timestamp))
 
-    def consume_errors(self):
+    def read_errors(self, since=-1, limit=None):
         """
-        Generator for all errors on the server error stack. Errors are removed from the stack (popped).
+        Reads errors from the error store without removing them, so several clients can poll independently.
+        :param since: Only errors with a sequence number greater than since are returned (cursor).
+        :param limit: Maximum number of errors to return (oldest first).
+        :return: List of (seq, error) tuples, oldest first
         """
-        self._error_lock.acquire()
-        while True:
-            try:
-                yield self._errors.pop()
-            except IndexError:
-                break
-        self._error_lock.release()
+        return self._errors.read(since, limit)
 
-    def consume_error(self):
+    def error_stats(self):
         """
-        Pops one error from the server error stack (read and remove).
-        :return: Last error
+        :return: dict with the number of retained, evicted and coalesced errors and the next sequence number
         """
-        self._error_lock.acquire()
-        r = self._errors.pop()
-        self._error_lock.release()
-        return r
+        return {
+            "retained": len(self._errors),
+            "evicted": self._errors.evicted,
+            "coalesced": self._errors.coalesced,
+            "next_seq": self._errors.next_seq,
+        }
 
     def has_error(self):
         return not self._errors.is_empty()
 
     def last_error(self):
         """
-        Reads the last error from the error stack. Does not remove it.
+        Reads the last error from the error store. Does not remove it.
         :return: Last error
         """
-        self._error_lock.acquire()
-        r = self._errors.top()
-        self._error_lock.release()
-        return r
+        return self._errors.top()
+
+    def acquire_keepalive(self):
+        """
+        Reserves one of the keepalive_max slots for a connection that is to stay open between requests.
+        :return: False if all slots are taken
+        """
+        with self._keepalive_lock:
+            if self._keepalive >= self.keepalive_max:
+                return False
+            self._keepalive += 1
+            return True
+
+    def release_keepalive(self):
+        with self._keepalive_lock:
+            self._keepalive -= 1
+
+    def _shutdown_plugin(self, plugin):
+        try:
+            plugin.shutdown()
+        except AttributeError:
+            logging.info("Plugin {} has no shutdown method.".format(plugin))
+            pass
+        except Exception as e:
+            logging.error("Plugin {} failed to shut down ({})".format(plugin, e))
 
     def shutdown(self):
         for plugin in self.plugins:
-            try:
-                plugin.shutdown()
-            except AttributeError:
-                logging.info("Plugin {} has no shutdown method.".format(plugin))
-                pass
-            except Exception as e:
-                logging.error("Plugin {} failed to shut down ({})".format(plugin, e))
+            self._shutdown_plugin(plugin)
 
         logging.info("Shutting down.")
         try:
-            self.shutdown()
+            self.engine.shutdown()
+            self.server_close()
         except Exception as e:
             logging.error("Clean shutdown failed ({})".format(e))
 
 
 class RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 request handler; connections are kept open between requests (see RESTServer.acquire_keepalive).
+    Responses need a known length for that: endpoints either send Content-Length (see respond()),
+    stream with Transfer-Encoding: chunked (see start_chunked()) or just write the body, which is then
+    buffered until the endpoint returns and sent with Content-Length.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body are separate writes; don't delay the body on open connections
+    max_drain = 64 * 1024  # bytes of an unread request body that are discarded to keep the connection open
+
     def __init__(self, *args, **kwargs):
+        self._init_state()
+        super().__init__(*args, **kwargs)
+
+    def _init_state(self):
         self.ep = None
         self._route = None
-        super().__init__(*args, **kwargs)
+        self.query = {}
+        self.status = None
+        self._keepalive = False
+        self._framed = False
+        self._connection = None  # Connection header sent by the endpoint
+        self._chunked = False
+        self._wfile = None
+        self._rfile = None
+        self.parent = None  # request handler this request was dispatched from (see RESTServer.dispatch_internal())
+
+    def setup(self):
+        self.timeout = self.server.keepalive_timeout
+        super().setup()
+
+    def finish(self):
+        if self._keepalive:
+            self._keepalive = False
+            self.server.release_keepalive()
+        super().finish()
+
+    def enclosing(self):
+        """
+        :return: endpoints of the requests this request was dispatched from, innermost first
+        """
+        r = []
+        handler = self.parent
+        while handler is not None:
+            r.append(handler.ep)
+            handler = handler.parent
+        return r
 
     @property
     def route(self):
@@ -261,10 +695,164 @@ class RequestHandler(BaseHTTPRequestHandler):
         assert(self.path.startswith(self.ep.path))
         return self.path[len(self.ep.path):]
 
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() in ["content-length", "transfer-encoding"]:
+            self._framed = True
+        elif keyword.lower() == "connection":
+            self._connection = value.lower()
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        """
+        Overrides super method. If the endpoint sent neither Content-Length nor Transfer-Encoding, the headers
+        are held back and the body is buffered until the endpoint returns (see finish_response()).
+        """
+        if self._framed or self.command == "HEAD" or self.status is None \
+                or self.status < 200 or self.status in [204, 304]:
+            self._connection_header()
+            super().end_headers()
+            return
+        self._wfile = self.wfile
+        self.wfile = io.BytesIO()
+
+    def _connection_header(self):
+        """
+        Takes a keep-alive slot for the connection if it has none yet and tells the client whether the connection
+        stays open; HTTP/1.0 clients need "keep-alive" on every response, HTTP/1.1 clients only "close".
+        """
+        if not self.close_connection and not self._keepalive:
+            self._keepalive = self.server.acquire_keepalive()
+            if not self._keepalive:
+                self.close_connection = True
+        if self.close_connection:
+            if self._connection != "close" and self.request_version != "HTTP/1.0":
+                super().send_header("Connection", "close")
+        elif self._connection is None and self.request_version == "HTTP/1.0":
+            super().send_header("Connection", "keep-alive")
+
+    def respond(self, code, body=b"", content_type=None, headers=None):
+        """
+        Sends a complete response with Content-Length.
+        :param body: bytes or str (sent as utf-8)
+        :param headers: dict of further headers
+        """
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(code)
+        if content_type is not None:
+            self.send_header("Content-Type", content_type)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def start_chunked(self):
+        """
+        Ends the headers of a response whose body is then sent piecewise with write_chunk() and end_chunked().
+        Uses chunked encoding; HTTP/1.0 clients get a buffered body instead.
+        """
+        if self.request_version != "HTTP/1.0":
+            self.send_header("Transfer-Encoding", "chunked")
+            self._chunked = True
+        self.end_headers()
+
+    def write_chunk(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not data:
+            return
+        if self._chunked:
+            self.wfile.write(b"%x\r\n%b\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def end_chunked(self):
+        if self._chunked:
+            self._chunked = False
+            self.wfile.write(b"0\r\n\r\n")
+
+    def finish_response(self):
+        """
+        Completes the response of the current request: terminates a chunked body and sends a buffered one.
+        """
+        self.end_chunked()
+        if self._wfile is None:
+            return
+        body = self.wfile.getvalue()
+        self.wfile = self._wfile
+        self._wfile = None
+        super().send_header("Content-Length", str(len(body)))
+        self._connection_header()
+        super().end_headers()
+        self.wfile.write(body)
+
+    def open_body(self):
+        """
+        Limits rfile to the request body, so an endpoint cannot read into the next request on the connection.
+        Bodies without a known length are not supported; the connection is closed after the response.
+        """
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0 or "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            self.close_connection = True
+            return
+        self._rfile = self.rfile
+        self.rfile = _BodyReader(self.rfile, length)
+
+    def close_body(self):
+        """
+        Discards the part of the request body the endpoint did not read, which would otherwise be parsed as the
+        next request. If more than max_drain bytes are left, the connection is closed instead.
+        """
+        if self._rfile is None:
+            return
+        body = self.rfile
+        self.rfile = self._rfile
+        self._rfile = None
+        if not self.close_connection and not body.drain(self.max_drain):
+            self.close_connection = True
+
     def do_method(self, method):
         logging.debug("Incoming {} on {}".format(method, self.path))
 
-        self.ep = self.server.match_endpoints(self.path)
+        start = time.perf_counter()
+        self.ep = None
+        self.status = None
+        self._framed = False
+        self._connection = None
+        self.open_body()
+        try:
+            self.dispatch(method)
+        except Exception:
+            self.close_connection = True
+            raise
+        finally:
+            # recorded before the response is completed, so a client sees its own request in the metrics
+            self.server.metrics.observe_request(self.ep.path if self.ep is not None else None, method,
+                                                self.status, time.perf_counter() - start)
+            self.close_body()
+            self.finish_response()
+            if self.status is None:
+                # nothing was sent; the client can only tell by the connection closing
+                self.close_connection = True
+
+    def dispatch(self, method):
+        path, _, query = self.path.partition("?")
+        self.query = parse_qs(query)
+        self.ep, self._route = self.server.match_route(path)
+        # placeholders of lazy or reloading plugins wait for the plugin; retired endpoints are routed again
+        while isinstance(self.ep, LazyEndpoint) or (self.ep is not None and not self.server.enter(self.ep)):
+            if isinstance(self.ep, LazyEndpoint):
+                self.server.load_lazy(self.ep)
+            self.ep, self._route = self.server.match_route(path)
         if self.ep is None:
             logging.info("No matching endpoint for {} found, sending 404".format(self.path))
             self.send_response(404)  # Not found
@@ -273,20 +861,20 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         try:
             logging.debug("Sending request to endpoint {}".format(self.ep.path))
-            if method == "GET":
-                self.ep.do_GET(self)
-            elif method == "POST":
-                self.ep.do_POST(self)
-            elif method == "PUT":
-                self.ep.do_PUT(self)
-            elif method == "HEAD":
-                self.ep.do_HEAD(self)
-            else:
+            if method not in ["GET", "POST", "PUT", "HEAD"] or not hasattr(self.ep, "do_" + method):
                 raise MethodError
+            handler = getattr(self.ep, "do_" + method)
+            profiler = self.server.profiler
+            if profiler.remaining and profiler.claim(self.ep):
+                profiler.run(handler, self)
+            else:
+                handler(self)
         except MethodError:
             logging.debug("Endpoint {} does not support method {}, sending 405".format(self.ep.path, method))
             self.send_response(405)  # Method not allowed
             self.end_headers()
+        finally:
+            self.server.leave(self.ep)
 
     def do_POST(self):
         self.do_method("POST")
@@ -301,6 +889,100 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.do_method("HEAD")
 
 
+class InternalRequest(RequestHandler):
+    """
+    Request dispatched inside the server without a connection (see RESTServer.dispatch_internal()).
+    Endpoints see the same handler interface; the response is written to a buffer.
+    """
+    def __init__(self, server, method, path, body=b"", headers=None, client_address=("internal", 0), parent=None):
+        self._init_state()
+        self.parent = parent
+        self.server = server
+        self.client_address = client_address
+        self.command = method
+        self.path = path
+        self.request_version = "HTTP/1.1"
+        self.requestline = "{} {} HTTP/1.1".format(method, path)
+        self.close_connection = True
+        header_lines = "".join("{}: {}\r\n".format(key, value) for key, value in (headers or {}).items()
+                               if key.lower() != "content-length")
+        header_lines += "Content-Length: {}\r\n\r\n".format(len(body))
+        self.headers = http.client.parse_headers(io.BytesIO(header_lines.encode("latin-1")))
+        self.rfile = io.BytesIO(body)
+        self.wfile = io.BytesIO()
+
+    def log_message(self, format, *args):
+        logging.debug("Internal request: " + format % args)
+
+    def dispatch(self, method):
+        """
+        Overrides super method; a failing or silent endpoint is answered with 500, so the caller and the
+        metrics see the same status.
+        """
+        try:
+            super().dispatch(method)
+        except Exception as e:
+            logging.exception("Internal {} on {} failed ({})".format(method, self.path, e))
+        if self.status is None:
+            self.send_response(500)  # internal server error
+            self.end_headers()
+
+    def response(self):
+        """
+        :return: (status, HTTPMessage headers, body bytes) of the response written by the endpoint
+        """
+        resp = http.client.HTTPResponse(_BufferSocket(self.wfile.getvalue()), method=self.command)
+        resp.begin()
+        return resp.status, resp.headers, resp.read()
+
+
+class _BodyReader:
+    """
+    Request body of a known length on top of the connection's rfile; reads stop at the end of the body.
+    """
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.read(size) if size else b""
+        self.remaining = self.remaining - len(data) if len(data) == size else 0
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.readline(size) if size else b""
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def drain(self, limit):
+        """
+        Reads and discards the rest of the body if it is at most limit bytes.
+        :return: True if the whole body was consumed
+        """
+        if self.remaining > limit:
+            return False
+        size = self.remaining
+        return len(self.read()) == size
+
+
+class _BufferSocket:
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args, **kwargs):
+        return io.BytesIO(self.data)
+
+
+def format_timestamp(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
 def sanitize_path(path):
     """
     Removes trailing / and adds leading /; e.g. "/endpoint/path"
@@ -321,6 +1003,10 @@ def parse_args(args):
         "debug": DEBUG,
         "yttest": False,
         "yttestlink": None,
+        "engine": ENGINE,
+        "workers": WORKERS,
+        "manifest": MANIFEST,
+        "startup_report": False,
     }
 
     i = 1
@@ -335,6 +1021,32 @@ def parse_args(args):
             i += 1
         elif args[i] == "--debug":
             config["debug"] = True
+        elif args[i] == "--engine":
+            try:
+                config["engine"] = args[i+1]
+            except IndexError:
+                raise ParseError("Engine not specified.")
+            if config["engine"] not in ENGINES:
+                raise ParseError("{} is not a valid engine.".format(config["engine"]))
+            i += 1
+        elif args[i] == "--workers":
+            try:
+                config["workers"] = int(args[i+1])
+            except IndexError:
+                raise ParseError("Number of workers not specified.")
+            except ValueError:
+                raise ParseError("{} is not a valid number of workers.".format(args[i+1]))
+            if config["workers"] < 1:
+                raise ParseError("At least one worker is required.")
+            i += 1
+        elif args[i] == "--manifest":
+            try:
+                config["manifest"] = args[i+1]
+            except IndexError:
+                raise ParseError("Manifest not specified.")
+            i += 1
+        elif args[i] == "--startup-report":
+            config["startup_report"] = True
         elif args[i] == "--help":
             config["help"] = True
         elif args[i] == "--yttest":
@@ -360,7 +1072,12 @@ def main(args):
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    RESTServer(config)
+    start = time.perf_counter()
+    server = RESTServer(config)
+    if config["startup_report"]:
+        print(server.startup_report())
+        print("Server ready after {:.1f} ms".format((time.perf_counter() - start) * 1000))
+    server.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for routing and dispatch.
+
+Starts a RESTServer with synthetic stub endpoints of varying depth and measures
+    match_endpoints  route lookup only
+    dispatch         RequestHandler.do_method without sockets (lookup, endpoint call, metrics)
+    round_trip       HTTP requests from concurrent local clients, per engine, with a new connection per request
+                     and with keep-alive connections
+Results are printed and written as JSON; with --compare, a previous result file is checked for regressions.
+
+Usage (from the test directory):
+    python bench.py [--endpoints N] [--clients N] [--requests N] [--engines threads,asyncio]
+                    [--output FILE] [--compare FILE] [--tolerance PERCENT]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import argparse
+import http.client
+import platform
+import random
+import json
+import time
+import sys
+import io
+sys.path.append("..")
+import server as restserver
+
+
+MAX_DEPTH = 6  # path segments of the deepest stub endpoint
+MISS_RATIO = 0.1  # share of requests to paths without endpoint
+BODY = b"ok"
+
+
+class StubEndpoint(restserver.Endpoint):
+    def do_GET(self, reqhandler):
+        reqhandler.send_response(200)
+        reqhandler.send_header("Content-Length", str(len(BODY)))
+        reqhandler.end_headers()
+        reqhandler.wfile.write(BODY)
+
+
+class QuietHandler(restserver.RequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(endpoints, engine="threads", workers=restserver.WORKERS):
+    """
+    :return: RESTServer on a free port with endpoints stub endpoints; their paths are in server.bench_paths
+    """
+    server = restserver.RESTServer({"port": 0, "plugindir": None, "engine": engine, "workers": workers,
+                                    "keepalive": workers})
+    server.RequestHandlerClass = QuietHandler
+    server.bench_paths = []
+    for i in range(endpoints):
+        depth = 1 + i % MAX_DEPTH
+        path = "/bench/e{}".format(i) + "".join("/s{}".format(j) for j in range(1, depth))
+        server.register_endpoint(StubEndpoint(path))
+        server.bench_paths.append(path)
+    return server
+
+
+def request_paths(server, count, seed=0):
+    """
+    :return: count request paths; most hit an endpoint (some with a remaining route), MISS_RATIO miss
+    """
+    rnd = random.Random(seed)
+    r = []
+    for _ in range(count):
+        if rnd.random() < MISS_RATIO:
+            r.append("/missing/{}".format(rnd.randrange(1000)))
+            continue
+        path = rnd.choice(server.bench_paths)
+        if rnd.random() < 0.5:
+            path += "/route/{}".format(rnd.randrange(1000))
+        r.append(path)
+    return r
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize(latencies, elapsed):
+    """
+    :param latencies: seconds per operation
+    :param elapsed: wall time of all operations in seconds
+    """
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def bench_match(server, paths):
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for path in paths:
+        t = clock()
+        server.match_endpoints(path)
+        latencies.append(clock() - t)
+    return summarize(latencies, clock() - start)
+
+
+def bench_dispatch(server, paths):
+    handler = QuietHandler.__new__(QuietHandler)
+    handler._init_state()
+    handler.server = server
+    handler.client_address = ("127.0.0.1", 0)
+    handler.request_version = "HTTP/1.0"
+    handler.requestline = "GET / HTTP/1.0"
+    handler.command = "GET"
+    handler.headers = http.client.HTTPMessage()
+    handler.rfile = io.BytesIO()
+    handler.close_connection = True
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for path in paths:
+        handler.path = path
+        handler.wfile = io.BytesIO()
+        handler._headers_buffer = []
+        t = clock()
+        handler.do_method("GET")
+        latencies.append(clock() - t)
+    return summarize(latencies, clock() - start)
+
+
+def bench_round_trip(server, paths, clients, keepalive=False):
+    """
+    :param keepalive: Reuse the connection of a client as long as the server keeps it open
+    """
+    port = server.server_address[1]
+
+    def client(chunk):
+        latencies = []
+        conn = None
+        for path in chunk:
+            t = time.perf_counter()
+            if conn is None:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            try:
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                raise
+            if not keepalive or resp.will_close:
+                conn.close()
+                conn = None
+            latencies.append(time.perf_counter() - t)
+        if conn is not None:
+            conn.close()
+        return latencies
+
+    chunks = [paths[i::clients] for i in range(clients)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = [el for result in executor.map(client, chunks) for el in result]
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def run(args):
+    results = {}
+    server = make_server(args.endpoints)
+    paths = request_paths(server, args.lookups)
+    results["match_endpoints"] = bench_match(server, paths)
+    results["dispatch"] = bench_dispatch(server, paths)
+    server.server_close()
+
+    for engine in args.engines:
+        server = make_server(args.endpoints, engine, args.workers)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            results["round_trip[{}]".format(engine)] = bench_round_trip(
+                server, request_paths(server, args.requests, seed=1), args.clients)
+            results["round_trip[{},keepalive]".format(engine)] = bench_round_trip(
+                server, request_paths(server, args.requests, seed=1), args.clients, keepalive=True)
+        finally:
+            server.shutdown()
+
+    return {
+        "meta": {
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "endpoints": args.endpoints,
+            "lookups": args.lookups,
+            "requests": args.requests,
+            "clients": args.clients,
+            "workers": args.workers,
+        },
+        "results": results,
+    }
+
+
+def compare(previous, current, tolerance):
+    """
+    :param tolerance: allowed slowdown in percent
+    :return: list of messages, one per regressed benchmark
+    """
+    r = []
+    for name, result in current["results"].items():
+        old = previous["results"].get(name)
+        if old is None:
+            continue
+        for key, worse in [("ops_per_sec", lambda a, b: a < b), ("p99_ms", lambda a, b: a > b)]:
+            if old.get(key) is None or result.get(key) is None:
+                continue
+            if key == "ops_per_sec":
+                limit = old[key] * (1 - tolerance / 100)
+            else:
+                limit = old[key] * (1 + tolerance / 100)
+            if worse(result[key], limit):
+                r.append("{} {}: {:.4g} -> {:.4g}".format(name, key, old[key], result[key]))
+    return r
+
+
+def format_results(report):
+    lines = ["{:<30} {:>12} {:>10} {:>10}".format("benchmark", "ops/s", "p50 ms", "p99 ms")]
+    for name, result in report["results"].items():
+        lines.append("{:<30} {:>12.0f} {:>10.4f} {:>10.4f}".format(
+            name, result["ops_per_sec"], result["p50_ms"], result["p99_ms"]))
+    return "\n".join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Routing and dispatch benchmark")
+    parser.add_argument("--endpoints", type=int, default=500, help="stub endpoints to register")
+    parser.add_argument("--lookups", type=int, default=100000, help="paths for match_endpoints and dispatch")
+    parser.add_argument("--requests", type=int, default=5000, help="HTTP requests per engine")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument("--workers", type=int, default=restserver.WORKERS)
+    parser.add_argument("--engines", default="threads", type=lambda s: s.split(","),
+                        help="comma separated, out of [{}]".format("|".join(restserver.ENGINES)))
+    parser.add_argument("--output", default="bench_results.json", help="JSON result file")
+    parser.add_argument("--compare", help="previous JSON result file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=10, help="allowed slowdown in percent")
+    args = parser.parse_args(argv[1:])
+    for engine in args.engines:
+        if engine not in restserver.ENGINES:
+            parser.error("{} is not a valid engine.".format(engine))
+
+    report = run(args)
+    print(format_results(report))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        regressions = compare(previous, report, args.tolerance)
+        for el in regressions:
+            print("REGRESSION " + el)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
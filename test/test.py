@@ -1,9 +1,35 @@
 #!/usr/bin/env python3
 import unittest
 import sys
+import os
+import json
+import time
+import tempfile
+import importlib
+import pstats
+import http.client
+import socket
+import socketserver
+import io
+from threading import Thread, Event, Barrier, Lock
 sys.path.append("..")
 import server as restserver
+import endpoints.errors as errors
+import endpoints.metrics as metricsendpoint
+import endpoints.profile as profile
+import endpoints.plugins as plugins
+import endpoints.batch as batch
+from routing import RouteIndex
+from util import Journal
+from metrics import Histogram
 import endpoints.yt as yt
+import endpoints.denon as denon
+import endpoints.rcswitch as rcswitch
+
+
+def touch(videodir, filename, size=0):
+    with open(os.path.join(videodir, filename), "wb") as f:
+        f.write(b"\0" * size)
 
 
 class TestServerMethods(unittest.TestCase):
@@ -11,7 +37,8 @@ class TestServerMethods(unittest.TestCase):
         pass
 
     def test_match_endpoints(self):
-        server = restserver.RESTServer(("", 8080), restserver.RequestHandler)
+        server = restserver.RESTServer({"port": 0, "plugindir": None})
+        self.addCleanup(server.server_close)
 
         self.assertEqual(server.match_endpoints("/a"), None, "incorrect behavior on empty endpoint list")
 
@@ -44,6 +71,878 @@ class TestServerMethods(unittest.TestCase):
         self.assertEqual(server.match_endpoints("/"), ep_root, "matching on / failed")
         self.assertEqual(server.match_endpoints("/c"), ep_root, "matching on / failed")
 
+    def test_match_route(self):
+        server = restserver.RESTServer({"port": 0, "plugindir": None})
+        self.addCleanup(server.server_close)
+
+        ep_root = restserver.Endpoint("/")
+        ep_ab = restserver.Endpoint("/a/b")
+        server.register_endpoint(ep_root)
+        server.register_endpoint(ep_ab)
+        server.register_endpoint(restserver.Endpoint("/a/b/"))  # duplicate, ignored
+
+        self.assertEqual(server.match_route("/a/b"), (ep_ab, ""))
+        self.assertEqual(server.match_route("/a/b/"), (ep_ab, "/"))
+        self.assertEqual(server.match_route("/a/b/c/d"), (ep_ab, "/c/d"))
+        self.assertEqual(server.match_route("/a/bc"), (ep_root, "/a/bc"))
+        self.assertEqual(server.match_route("/A/B/On"), (ep_ab, "/On"), "case insensitive matching failed")
+
+    def test_route_index_options(self):
+        ep_ab = restserver.Endpoint("/a/b")
+
+        index = RouteIndex(case_sensitive=True)
+        index.add(ep_ab)
+        self.assertEqual(index.lookup("/A/b"), (None, None))
+        self.assertEqual(index.lookup("//a/b"), (None, None))
+
+        index = RouteIndex(ignore_double_slash=True)
+        index.add(ep_ab)
+        self.assertEqual(index.lookup("//a//b/c"), (ep_ab, "/c"))
+        self.assertTrue(index.remove(ep_ab))
+        self.assertEqual(index.lookup("/a/b"), (None, None))
+
+
+class TestJournal(unittest.TestCase):
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "queue.journal")
+            journal = Journal(path, fsync_interval=None, compact_threshold=4)
+            for el in ["a", "b", "c"]:
+                journal.add(el)
+            journal.done(0)
+            journal.close()
+            with open(path, "a") as f:
+                f.write('{"a": 3, "i": "tor')  # torn write
+
+            journal = Journal(path, compact_threshold=2)
+            self.assertEqual(journal.pending(), [(1, "b"), (2, "c")])
+            self.assertEqual(journal.add("d"), 3)
+            journal.done(1)
+            journal.done(2)
+            journal.close()
+
+            # compacted: only the pending item is left
+            with open(path) as f:
+                self.assertEqual(f.read(), '{"a": 3, "i": "d"}\n')
+            self.assertEqual(Journal(path).pending(), [(3, "d")])
+
+            journal = Journal(path)
+            self.assertEqual(journal.add_many(["e", "f"]), [4, 5])
+            journal.close()
+            self.assertEqual(Journal(path).pending(), [(3, "d"), (4, "e"), (5, "f")])
+
+    def test_queue_restore(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = Journal(os.path.join(tmp, "queue.journal"))
+            journal.add("a")
+            queue = Collector(journal)
+            queue.append("b")
+            wait_until(lambda: len(journal) == 0)
+            self.assertEqual(queue.seen, ["a", "b"])
+            self.assertEqual(queue.backlog(), 0)
+
+            # stopped: queued elements stay in the journal for the next run
+            queue.stop()
+            queue.join(5)
+            self.assertFalse(queue.is_alive())
+            queue.append("c")
+            time.sleep(0.05)
+            self.assertEqual(queue.seen, ["a", "b"])
+            self.assertEqual(journal.pending(), [(2, "c")])
+
+    def test_queue_capacity(self):
+        queue = Collector(capacity=2)
+        queue.release.clear()
+        queue.append("a")
+        queue.append("b")
+        self.assertRaises(yt.QueueFull, queue.append, "c")
+
+        stats = queue.stats()
+        self.assertEqual((stats["backlog"], stats["rejected"]), (2, 1))
+        self.assertIsNotNone(stats["oldest_wait"])
+
+        queue.release.set()
+        wait_until(lambda: queue.stats()["consumed"] == 2)
+        self.assertEqual(queue.stats()["backlog"], 0)
+        queue.append("c")
+
+        # concurrent producers cannot push the queue past its capacity
+        queue = Collector(capacity=5)
+        queue.release.clear()
+        producers = [Thread(target=queue.extend, args=(["x"] * 3,)) for _ in range(8)]
+        for thread in producers:
+            thread.start()
+        for thread in producers:
+            thread.join()
+        self.assertEqual(queue.backlog(), 5)
+        self.assertEqual(queue.stats()["rejected"], 19)
+        queue.release.set()
+
+
+class TestErrorStore(unittest.TestCase):
+    def test_coalescing(self):
+        store = restserver.ErrorStore(2)
+        plugin = "yt"
+
+        self.assertEqual(store.push(restserver.Error(plugin, "a", 100)), 0)
+        self.assertEqual(store.push(restserver.Error(plugin, "b", 110)), 1)
+        self.assertEqual(store.push(restserver.Error(plugin, "a", 120)), 2)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.coalesced, 1)
+
+        a = store.top()
+        self.assertEqual((a.msg, a.count, a.first_seen, a.last_seen), ("a", 2, 100, 120))
+        self.assertEqual([el.msg for _, el in store.read()], ["b", "a"])
+        self.assertEqual([el.msg for _, el in store.read(since=1)], ["a"])
+
+        # "b" is the least recently reported record
+        store.push(restserver.Error(plugin, "c", 130))
+        self.assertEqual(store.evicted, 1)
+        self.assertEqual([el.msg for _, el in store.read()], ["a", "c"])
+        self.assertEqual(store.read(limit=1)[0][1].serializable()["count"], 2)
+
+
+class TestErrorReporting(unittest.TestCase):
+    def setUp(self):
+        self.server = serve(self, errors.ErrorReporting("sys/errors"))
+
+    def get(self, path):
+        resp = request(self, self.server, "GET", path)
+        return resp.status, resp.getheader("X-Last-Seq"), resp.body.decode("utf-8")
+
+    def test_cursor(self):
+        for msg in ["a", "b", "c"]:
+            self.server.report_error("test", msg)
+
+        status, last_seq, body = self.get("/sys/errors?format=json&since=0&limit=1")
+        self.assertEqual(status, 200)
+        self.assertEqual(last_seq, "1")
+        self.assertEqual([el["msg"] for el in json.loads(body)], ["b"])
+
+        status, last_seq, body = self.get("/sys/errors/all?format=json&limit=2")
+        self.assertEqual([el["msg"] for el in json.loads(body)], ["c", "b"])
+
+        status, _, body = self.get("/sys/errors/all")
+        self.assertEqual(body, errors.format_errors([el for _, el in reversed(self.server.read_errors())]))
+        self.assertTrue(body.endswith("test:\na\n"))
+
+        self.assertEqual(self.get("/sys/errors?since=foo")[0], 400)
+        self.assertEqual(self.get("/sys/errors?format=xml")[0], 400)
+
+
+LAZY_PLUGIN = """
+from server import Endpoint
+
+loaded = 0
+
+
+class Hello(Endpoint):
+    def do_GET(self, reqhandler):
+        reqhandler.respond(200, "hello")
+
+
+class Plugin:
+    def __init__(self, rest_server):
+        global loaded
+        loaded += 1
+        self.name = "hello"
+        rest_server.register_endpoint(Hello("/hello"))
+        rest_server.register_endpoint(Hello("/hello/deep"))
+"""
+
+RELOAD_PLUGIN = """
+from server import Endpoint
+
+VERSION = {}
+
+
+class Slow(Endpoint):
+    def do_GET(self, reqhandler):
+        reqhandler.server.gate.wait(5)
+        reqhandler.respond(200, "v{{}}".format(VERSION))
+
+
+class Plugin:
+    def __init__(self, rest_server):
+        self.name = "slow"
+        self.server = rest_server
+        rest_server.register_endpoint(Slow("/slow"))
+
+    def shutdown(self):
+        self.server.shutdowns.append(VERSION)
+"""
+
+
+class TestLazyPlugins(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        sys.path.insert(0, tmp.name)
+        self.addCleanup(sys.path.remove, tmp.name)
+
+        os.mkdir("lazyplugins")
+        open(os.path.join("lazyplugins", "__init__.py"), "w").close()
+        with open(os.path.join("lazyplugins", "hello.py"), "w") as f:
+            f.write(LAZY_PLUGIN)
+        with open("manifest.json", "w") as f:
+            json.dump({"hello": ["/hello"]}, f)
+        importlib.invalidate_caches()
+        self.addCleanup(sys.modules.pop, "lazyplugins.hello", None)
+        self.addCleanup(sys.modules.pop, "lazyplugins", None)
+
+    def test_lazy(self):
+        server = restserver.RESTServer({"port": 0, "plugindir": "lazyplugins", "manifest": "manifest.json"})
+        self.addCleanup(server.server_close)
+        self.assertNotIn("lazyplugins.hello", sys.modules)
+        self.assertIsInstance(server.match_endpoints("/hello/deep"), restserver.LazyEndpoint)
+        self.assertIn("lazy, not loaded", server.startup_report())
+
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        self.addCleanup(conn.close)
+        for path in ["/hello/deep", "/hello"]:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            self.assertEqual((resp.status, resp.read()), (200, b"hello"))
+
+        module = sys.modules["lazyplugins.hello"]
+        self.assertEqual(module.loaded, 1)
+        self.assertEqual(server.match_endpoints("/hello/deep").path, "/hello/deep")
+        self.assertEqual(len(server.endpoints), 2)
+        self.assertIn("lazy, loaded", server.startup_report())
+
+    def test_reload(self):
+        with open(os.path.join("lazyplugins", "slow.py"), "w") as f:
+            f.write(RELOAD_PLUGIN.format(1))
+        self.addCleanup(sys.modules.pop, "lazyplugins.slow", None)
+        server = restserver.RESTServer({"port": 0, "plugindir": "lazyplugins"})
+        server.register_endpoint(plugins.PluginsEndpoint("sys/plugins"))
+        server.gate = Event()
+        server.shutdowns = []
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+
+        def get(path, results):
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            results.append((resp.status, resp.read()))
+            conn.close()
+
+        old, reload, new = [], [], []
+        Thread(target=get, args=("/slow", old)).start()
+        wait_until(lambda: any(server._inflight.values()))
+
+        with open(os.path.join("lazyplugins", "slow.py"), "w") as f:
+            f.write(RELOAD_PLUGIN.format(2))
+        importlib.invalidate_caches()
+        reloader = Thread(target=get, args=("/sys/plugins/reload/slow", reload))
+        reloader.start()
+        wait_until(lambda: isinstance(server.match_endpoints("/slow"), restserver.LazyEndpoint))
+        waiting = Thread(target=get, args=("/slow", new))
+        waiting.start()
+        time.sleep(0.1)
+        # the old plugin is only shut down once its running request is done
+        self.assertEqual(server.shutdowns, [])
+        self.assertEqual(reload, [])
+        # the drain does not block other plugin operations
+        info = []
+        get("/sys/plugins", info)
+        self.assertEqual(info[0][0], 200)
+        self.assertRaises(restserver.PluginError, server.reload_plugin, "slow")
+
+        server.gate.set()
+        reloader.join()
+        waiting.join()
+        wait_until(lambda: old)
+        self.assertEqual(old, [(200, b"v1")])
+        self.assertEqual(new, [(200, b"v2")])
+        self.assertEqual(reload[0][0], 200)
+        self.assertEqual(json.loads(reload[0][1])["endpoints"], ["/slow"])
+        self.assertEqual(server.shutdowns, [1])
+
+        get("/sys/plugins/reload/nothing", reload)
+        self.assertEqual(reload[-1][0], 404)
+
+    def test_reload_enclosing(self):
+        for name in ["batch", "plugins"]:
+            with open(os.path.join("lazyplugins", name + ".py"), "w") as f:
+                f.write("from endpoints.{} import Plugin\n".format(name))
+            self.addCleanup(sys.modules.pop, "lazyplugins." + name, None)
+        importlib.invalidate_caches()
+        server = serve(self, plugindir="lazyplugins")
+
+        # the batch request that reloads its own plugin would wait for itself
+        start = time.monotonic()
+        resp = request(self, server, "POST", "/batch", json.dumps([
+            {"method": "GET", "path": "/sys/plugins/reload/batch"},
+            {"method": "GET", "path": "/sys/plugins/reload/hello"},
+        ]))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual([el["status"] for el in json.loads(resp.body)], [500, 200])
+
+        # nested batches are refused after a reload as well
+        server.reload_plugin("batch")
+        resp = request(self, server, "POST", "/batch", json.dumps([{"method": "POST", "path": "/batch", "body": []}]))
+        self.assertEqual(json.loads(resp.body), [{"status": 400}])
+
+    def test_reload_failure(self):
+        server = restserver.RESTServer({"port": 0, "plugindir": "lazyplugins", "manifest": "manifest.json"})
+        server.register_endpoint(plugins.PluginsEndpoint("sys/plugins"))
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+
+        # a lazy plugin that is not loaded yet can be reloaded as well
+        self.assertEqual(request(self, server, "GET", "/sys/plugins/reload/hello").status, 200)
+        self.assertEqual(request(self, server, "GET", "/hello").body, b"hello")
+        self.assertEqual(request(self, server, "GET", "/sys/plugins/reload/nothing").status, 404)
+
+        # if the new version fails to initialize, its endpoints stay placeholders instead of disappearing
+        with open(os.path.join("lazyplugins", "hello.py"), "w") as f:
+            f.write("class Plugin:\n    def __init__(self, rest_server):\n        raise RuntimeError(\"broken\")\n")
+        importlib.invalidate_caches()
+        self.assertEqual(request(self, server, "GET", "/sys/plugins/reload/hello").status, 500)
+        self.assertIsInstance(server.match_endpoints("/hello"), restserver.LazyEndpoint)
+        self.assertEqual(server.plugin_info()[0]["endpoints"], ["/hello", "/hello/deep"])
+
+        # ... so a later reload can bring them back
+        with open(os.path.join("lazyplugins", "hello.py"), "w") as f:
+            f.write(LAZY_PLUGIN)
+        importlib.invalidate_caches()
+        self.assertEqual(request(self, server, "GET", "/sys/plugins/reload/hello").status, 200)
+        self.assertEqual(request(self, server, "GET", "/hello/deep").body, b"hello")
+
+    def test_eager(self):
+        server = restserver.RESTServer({"port": 0, "plugindir": "lazyplugins"})
+        self.addCleanup(server.server_close)
+        self.assertEqual(sys.modules["lazyplugins.hello"].loaded, 1)
+        self.assertEqual(server.match_endpoints("/hello").path, "/hello")
+        self.assertIsNotNone(server.startup["hello"]["init"])
+
+
+class TestEngines(unittest.TestCase):
+    class Gate(restserver.Endpoint):
+        def __init__(self, path):
+            self.lock = Lock()
+            self.running = 0
+            self.peak = 0
+            self.release = Event()
+            super().__init__(path)
+
+        def do_GET(self, reqhandler):
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            self.release.wait(5)
+            with self.lock:
+                self.running -= 1
+            reqhandler.respond(200, "ok")
+
+    def run_engine(self, engine, workers, clients):
+        """
+        Sends clients concurrent requests that block until all of them were accepted or queued.
+        :return: (requests running while blocked, statuses)
+        """
+        gate = self.Gate("gate")
+        server = restserver.RESTServer({"port": 0, "plugindir": None, "engine": engine, "workers": workers})
+        server.register_endpoint(gate)
+        serving = Thread(target=server.serve_forever, daemon=True)
+        serving.start()
+        statuses = []
+
+        def get():
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+            conn.request("GET", "/gate")
+            resp = conn.getresponse()
+            resp.read()
+            statuses.append(resp.status)
+            conn.close()
+
+        threads = [Thread(target=get) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        concurrency = 1 if engine == "single" else min(workers, clients)
+        wait_until(lambda: gate.running == concurrency)
+        time.sleep(0.1)  # the other clients wait for a free worker
+        running = gate.running
+        gate.release.set()
+        for thread in threads:
+            thread.join(10)
+
+        server.shutdown()
+        serving.join(5)
+        server.server_close()
+        self.assertFalse(serving.is_alive())
+        self.assertEqual(gate.peak, running)
+        return running, statuses
+
+    def test_single(self):
+        self.assertEqual(self.run_engine("single", 4, 3), (1, [200] * 3))
+
+    def test_threads(self):
+        self.assertEqual(self.run_engine("threads", 2, 4), (2, [200] * 4))
+
+    def test_asyncio(self):
+        self.assertEqual(self.run_engine("asyncio", 2, 4), (2, [200] * 4))
+
+    def test_keepalive_capacity(self):
+        server = restserver.RESTServer({"port": 0, "plugindir": None, "engine": "asyncio", "workers": 2})
+        self.addCleanup(server.server_close)
+        self.assertEqual(server.engine.keepalive_capacity(10), 1)
+        self.assertEqual(server.engine.keepalive_capacity(0), 0)
+        self.assertEqual(restserver.ENGINES["single"](server, 4).keepalive_capacity(10), 0)
+
+
+class TestKeepAlive(unittest.TestCase):
+    class Unframed(restserver.Endpoint):
+        def do_GET(self, reqhandler):
+            reqhandler.send_response(200)
+            reqhandler.end_headers()
+            reqhandler.wfile.write(b"hello")
+            reqhandler.wfile.write(b" world")
+
+    class Closing(restserver.Endpoint):
+        def do_GET(self, reqhandler):
+            reqhandler.respond(200, "bye", headers={"Connection": "close"})
+
+    def setUp(self):
+        self.server = restserver.RESTServer({"port": 0, "plugindir": None, "workers": 4, "keepalive": 1})
+        self.server.register_endpoint(errors.ErrorReporting("sys/errors"))
+        self.server.register_endpoint(self.Unframed("unframed"))
+        self.server.register_endpoint(self.Closing("closing"))
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+
+    def connect(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def get(self, conn, path):
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def test_reuse(self):
+        self.server.report_error("test", "a")
+        conn = self.connect()
+        resp, body = self.get(conn, "/unframed")
+        sock = conn.sock
+        self.assertEqual(body, b"hello world")
+        self.assertEqual(resp.getheader("Content-Length"), "11")
+        self.assertFalse(resp.will_close)
+
+        resp, body = self.get(conn, "/sys/errors?format=json")
+        self.assertEqual(resp.getheader("Transfer-Encoding"), "chunked")
+        self.assertEqual([el["msg"] for el in json.loads(body)], ["a"])
+        resp, body = self.get(conn, "/nothing")
+        self.assertEqual(resp.status, 404)
+        self.assertIs(conn.sock, sock)
+
+    def test_connection_header(self):
+        # HTTP/1.0 clients are told on every response that the connection stays open
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        self.addCleanup(sock.close)
+        for _ in range(2):
+            sock.sendall(b"GET /unframed HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+            resp = http.client.HTTPResponse(sock)
+            resp.begin()
+            self.assertEqual(resp.read(), b"hello world")
+            self.assertEqual(resp.msg.get_all("Connection"), ["keep-alive"])
+
+        # a close requested by the endpoint is not repeated
+        sock.sendall(b"GET /closing HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+        resp = http.client.HTTPResponse(sock)
+        resp.begin()
+        self.assertEqual(resp.read(), b"bye")
+        self.assertEqual(resp.msg.get_all("Connection"), ["close"])
+        resp, body = self.get(self.connect(), "/closing")
+        self.assertEqual(resp.msg.get_all("Connection"), ["close"])
+
+    def test_unread_body(self):
+        conn = self.connect()
+        smuggled = b"GET /nothing HTTP/1.1\r\nHost: x\r\n\r\n"
+        conn.request("POST", "/sys/errors", smuggled)
+        resp = conn.getresponse()
+        resp.read()
+        self.assertEqual(resp.status, 405)
+        self.assertFalse(resp.will_close)
+        # the body was discarded, not parsed as the next request
+        resp, body = self.get(conn, "/unframed")
+        self.assertEqual(body, b"hello world")
+
+        # reads stop at the end of the body; larger rests are not drained
+        body = restserver._BodyReader(io.BytesIO(b"abc\ndefNEXT"), 7)
+        self.assertEqual(body.readline(), b"abc\n")
+        self.assertEqual(body.read(), b"def")
+        self.assertEqual(body.read(), b"")
+        self.assertFalse(restserver._BodyReader(io.BytesIO(b"abcdef"), 6).drain(5))
+        self.assertTrue(restserver._BodyReader(io.BytesIO(b"abcdef"), 6).drain(6))
+
+    def test_cap(self):
+        first = self.connect()
+        self.assertFalse(self.get(first, "/unframed")[0].will_close)
+        # the only keep-alive slot is taken by the first connection
+        second = self.connect()
+        resp, body = self.get(second, "/unframed")
+        self.assertEqual(body, b"hello world")
+        self.assertTrue(resp.will_close)
+
+        first.close()
+        wait_until(lambda: self.server._keepalive == 0)
+        third = self.connect()
+        self.assertFalse(self.get(third, "/unframed")[0].will_close)
+
+    def test_capacity(self):
+        self.assertEqual(self.server.keepalive_max, 1)
+        self.assertEqual(self.server.engine.keepalive_capacity(10), 3)
+        single = restserver.RESTServer({"port": 0, "plugindir": None, "engine": "single"})
+        self.addCleanup(single.server_close)
+        self.assertEqual(single.keepalive_max, 0)
+
+
+class TestBatch(unittest.TestCase):
+    class Recorder(restserver.Endpoint):
+        def __init__(self, path):
+            self.seen = []
+            self.barrier = Barrier(2, timeout=2)
+            super().__init__(path)
+
+        def do_GET(self, reqhandler):
+            if reqhandler.route == "/wait":
+                self.barrier.wait()
+            elif reqhandler.route == "/fail":
+                raise RuntimeError("failed")
+            elif reqhandler.route == "/silent":
+                return
+            self.seen.append(reqhandler.route)
+            reqhandler.send_response(204)
+            reqhandler.end_headers()
+
+        def do_POST(self, reqhandler):
+            body = reqhandler.rfile.read(int(reqhandler.headers["Content-Length"]))
+            reqhandler.respond(201, body, reqhandler.headers.get("Content-Type"))
+
+    def setUp(self):
+        self.recorder = self.Recorder("rec")
+        self.server = serve(self, self.recorder, errors.ErrorReporting("sys/errors"), batch.BatchEndpoint("batch"))
+
+    def post(self, data):
+        resp = request(self, self.server, "POST", "/batch", json.dumps(data))
+        return resp.status, json.loads(resp.body) if resp.status == 200 else resp.body
+
+    def test_batch(self):
+        self.server.report_error("test", "a")
+        status, results = self.post({"requests": [
+            {"method": "GET", "path": "/rec/1"},
+            {"method": "POST", "path": "/rec", "body": {"link": "x"}},
+            {"method": "get", "path": "/sys/errors/last?format=json"},
+            {"method": "GET", "path": "/nothing"},
+            {"method": "DELETE", "path": "/rec"},
+            {"method": "POST", "path": "/batch", "body": []},
+            {"method": "GET", "path": "/rec/2"},
+        ]})
+        self.assertEqual(status, 200)
+        self.assertEqual([el["status"] for el in results], [204, 201, 200, 404, 400, 400, 204])
+        self.assertEqual(json.loads(results[1]["body"]), {"link": "x"})
+        self.assertEqual(json.loads(results[2]["body"])[0]["msg"], "a")
+        self.assertEqual(self.recorder.seen, ["/1", "/2"])
+        self.assertEqual(self.post({"foo": []})[0], 400)
+
+    def test_independent(self):
+        # both sub-requests wait for each other: only possible if they run concurrently
+        status, results = self.post([
+            {"method": "GET", "path": "/rec/wait", "independent": True},
+            {"method": "GET", "path": "/rec/wait", "independent": True},
+            {"method": "GET", "path": "/rec/last"},
+        ])
+        self.assertEqual([el["status"] for el in results], [204, 204, 204])
+        self.assertEqual(self.recorder.seen[-1], "/last")
+
+    def test_failure(self):
+        status, results = self.post([
+            {"method": "GET", "path": "/rec/fail"},
+            {"method": "GET", "path": "/rec/silent"},
+            {"method": "GET", "path": "/rec/1"},
+        ])
+        self.assertEqual([el["status"] for el in results], [500, 500, 204])
+        # the metrics record the status the batch reported
+        lines = self.server.metrics.render().splitlines()
+        self.assertIn('http_requests_total{endpoint="/rec",method="GET",status="500"} 2', lines)
+        self.assertNotIn("none", "".join(el for el in lines if el.startswith('http_requests_total{endpoint="/rec"')))
+
+        status, _, body = self.server.dispatch_internal("GET", "/rec/fail")
+        self.assertEqual((status, body), (500, b""))
+
+    def test_headers(self):
+        status, results = self.post([
+            {"method": "POST", "path": "/rec", "body": "abc", "headers": {"Content-Length": "1000"}},
+            {"method": "GET", "path": "/rec/1", "headers": {"X-Test": "a\r\nX-Injected: b"}},
+            {"method": "GET", "path": "/rec/1", "headers": {"X-Test": 1}},
+            {"method": "GET", "path": "/rec/1", "headers": {"X-Test": "\u20ac"}},
+            {"method": "GET", "path": "/rec/1", "headers": {"X-Test:": "a"}},
+        ])
+        self.assertEqual([el["status"] for el in results], [201, 400, 400, 400, 400])
+        # the Content-Length of the body is used, not the one given
+        self.assertEqual(results[0]["body"], "abc")
+        self.assertEqual(self.recorder.seen, [])
+        # a header that cannot be encoded fails the sub-request, not the caller
+        status, _, _ = self.server.dispatch_internal("GET", "/rec/1", headers={"X-Test": "\u20ac"})
+        self.assertEqual(status, 500)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = serve(self, errors.ErrorReporting("sys/errors"), metricsendpoint.MetricsEndpoint("sys/metrics"))
+
+    def request(self, method, path):
+        resp = request(self, self.server, method, path)
+        return resp.status, resp.body.decode("utf-8")
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1))
+        for el in [0.05, 0.1, 0.5, 3]:
+            histogram.observe(el)
+        self.assertEqual(histogram.cumulative(), [(0.1, 2), (1, 3), ("+Inf", 4)])
+        self.assertEqual(histogram.count, 4)
+
+    def test_render(self):
+        def collector():
+            return [("test_depth", "gauge", "Test.", [({"queue": "a"}, 3)])]
+
+        self.server.metrics.add_collector(collector)
+        self.request("GET", "/sys/errors")
+        self.request("GET", "/sys/errors?format=xml")
+        self.request("POST", "/sys/errors")
+        self.request("GET", "/nothing")
+
+        status, body = self.request("GET", "/sys/metrics")
+        self.assertEqual(status, 200)
+        lines = body.splitlines()
+        self.assertIn('http_requests_total{endpoint="/sys/errors",method="GET",status="200"} 1', lines)
+        self.assertIn('http_requests_total{endpoint="/sys/errors",method="GET",status="400"} 1', lines)
+        self.assertIn('http_requests_total{endpoint="/sys/errors",method="POST",status="405"} 1', lines)
+        self.assertIn('http_requests_total{endpoint="none",method="GET",status="404"} 1', lines)
+        self.assertIn('http_request_duration_seconds_count{endpoint="/sys/errors",method="GET"} 2', lines)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="/sys/errors",method="GET",le="+Inf"} 2',
+                      lines)
+        self.assertIn("# TYPE test_depth gauge", lines)
+        self.assertIn('test_depth{queue="a"} 3', lines)
+
+        self.server.metrics.remove_collector(collector)
+        self.assertNotIn("test_depth", self.server.metrics.render())
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.server = serve(self, errors.ErrorReporting("sys/errors"), profile.ProfileEndpoint("sys/profile"))
+
+    def get(self, path):
+        resp = request(self, self.server, "GET", path)
+        return resp.status, resp.body
+
+    def test_profile(self):
+        self.assertEqual(self.get("/sys/profile/report")[0], 404)
+        self.assertEqual(self.get("/sys/profile/start?endpoint=/nothing")[0], 400)
+
+        status, body = self.get("/sys/profile/start?endpoint=/SYS/errors&samples=2")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {"endpoint": "/sys/errors", "remaining": 2, "profiled": 0})
+        for _ in range(3):
+            self.get("/sys/errors")
+        # the sample is recorded after the response was sent
+        wait_until(lambda: self.server.profiler.status()["profiled"] == 2)
+        self.assertEqual(self.server.profiler.remaining, 0)
+
+        status, body = self.get("/sys/profile/report?sort=tottime")
+        self.assertEqual(status, 200)
+        self.assertIn(b"do_GET", body)
+        self.assertEqual(self.get("/sys/profile/report?sort=foo")[0], 400)
+
+        status, body = self.get("/sys/profile/report?format=pstats")
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(body)
+            f.flush()
+            stats = pstats.Stats(f.name)
+        self.assertTrue(any(name == "do_GET" for _, _, name in stats.stats))
+
+        # the target is matched by path, so it still applies after a plugin (re)load replaced the endpoint
+        self.server.profiler.start(1, "/sys/errors")
+        self.assertFalse(self.server.profiler.claim(restserver.Endpoint("sys/profile")))
+        self.assertTrue(self.server.profiler.claim(errors.ErrorReporting("sys/errors")))
+
+
+class FakeDenon(socketserver.ThreadingTCPServer):
+    """
+    Telnet server that records the commands it receives and answers status queries like the receiver.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        self.commands = []
+        self.connections = 0
+        self.socks = []
+        self.ignored = set()  # commands the receiver does not react to
+        self.state = {"PW": "STANDBY", "SI": "TV"}
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(handler):
+                self.connections += 1
+                self.socks.append(handler.request)
+                buf = b""
+                while True:
+                    data = handler.request.recv(1024)
+                    if not data:
+                        return
+                    buf += data
+                    *lines, buf = buf.split(b"\r")
+                    for line in lines:
+                        self.receive(handler.request, line.decode("ascii"))
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def receive(self, sock, cmd):
+        self.commands.append(cmd)
+        if cmd in self.ignored:
+            return
+        key, value = cmd[:2], cmd[2:]
+        if key in self.state and value != "?":
+            self.state[key] = value
+        if key in self.state:
+            sock.sendall("{}{}\r".format(key, self.state[key]).encode("ascii"))
+
+    def drop(self):
+        for sock in self.socks:
+            sock.shutdown(socket.SHUT_RDWR)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestDenon(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeDenon()
+        self.addCleanup(self.fake.stop)
+        self.connection = denon.DenonConnection(*self.fake.server_address, interval=0)
+        self.addCleanup(self.connection.close)
+        self.state = denon.DenonState(self.connection, window=0)
+
+    def test_persistent_connection(self):
+        self.assertEqual(denon.switch("on", self.state), 200)
+        self.assertEqual(denon.source("rpi", self.state), 200)
+        self.assertEqual(denon.source("foo", self.state), 404)
+        wait_until(lambda: len(self.fake.commands) == 2)
+        self.assertEqual(self.fake.commands, ["PWON", "SIMPLAY"])
+        self.assertEqual(self.connection.connects, 1)
+
+        # reconnect after the connection broke; the cached state is dropped
+        self.connection.sock.close()
+        denon.switch("off", self.state)
+        wait_until(lambda: len(self.fake.commands) == 4)
+        self.assertEqual(self.fake.commands[2:], ["PWSTANDBY", "Z2OFF"])
+        self.assertEqual(self.connection.connects, 2)
+
+    def test_state(self):
+        self.assertEqual(self.state.query(), {"PW": "STANDBY", "SI": "TV"})
+        self.assertEqual(self.fake.commands, ["PW?", "SI?"])
+
+        # cached: no further queries, redundant commands are skipped
+        self.assertEqual(self.state.query(), {"PW": "STANDBY", "SI": "TV"})
+        denon.switch("off", self.state)
+        denon.source("tv", self.state)
+        denon.switch("on", self.state)
+        wait_until(lambda: len(self.fake.commands) == 4)
+        # zone 2 is switched off even though the main zone already is
+        self.assertEqual(self.fake.commands, ["PW?", "SI?", "Z2OFF", "PWON"])
+        self.assertEqual(self.state.skipped, 2)
+
+        # the receiver reports changes made elsewhere
+        self.state.update("SIBD")
+        self.assertEqual(self.state.get("SI"), "BD")
+
+        # the cached state is dropped when the receiver closes the connection
+        self.fake.drop()
+        wait_until(lambda: self.state.get("PW") is None)
+
+    def test_ignored(self):
+        # a command the receiver did not confirm is not skipped when repeated
+        self.fake.ignored.add("SIMPLAY")
+        denon.source("rpi", self.state)
+        denon.source("rpi", self.state)
+        wait_until(lambda: len(self.fake.commands) == 2)
+        self.assertEqual(self.fake.commands, ["SIMPLAY", "SIMPLAY"])
+        self.assertEqual(self.state.skipped, 0)
+
+    def test_coalesce(self):
+        self.state.window = 0.2
+        # the first command is sent right away
+        start = time.monotonic()
+        denon.source("pc", self.state)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+        # commands within the window are coalesced into the last one
+        threads = []
+        for inputsource in ["tv", "pc", "rpi"]:
+            threads.append(Thread(target=denon.source, args=(inputsource, self.state)))
+            threads[-1].start()
+            time.sleep(0.02)
+        for thread in threads:
+            thread.join()
+        wait_until(lambda: len(self.fake.commands) == 2)
+        self.assertEqual(self.fake.commands, ["SIBD", "SIMPLAY"])
+        self.assertEqual(self.state.coalesced, 2)
+
+
+class TestRCSwitch(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.log = os.path.join(tmp.name, "log")
+        self.command = os.path.join(tmp.name, "rcswitch")
+        with open(self.command, "w") as f:
+            f.write("#!/bin/sh\nsleep 0.1\necho \"$@\" >> {}\n".format(self.log))
+        os.chmod(self.command, 0o755)
+
+    def calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_background(self):
+        switcher = rcswitch.Switcher(command=self.command)
+        self.addCleanup(switcher.shutdown)
+        start = time.monotonic()
+        future = switcher.submit(rcswitch.CHANNELS, "on")
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(self.calls(), [])
+        self.assertEqual(future.result(5), [0, 0, 0, 0])
+        self.assertEqual(self.calls(), ["a on", "b on", "c on", "d on"])
+
+    def test_batch(self):
+        switcher = rcswitch.Switcher(command=self.command, batch=True)
+        self.addCleanup(switcher.shutdown)
+        switcher.submit(rcswitch.CHANNELS, "off").result(5)
+        switcher.submit(["b"], "on").result(5)
+        self.assertEqual(self.calls(), ["a b c d off", "b on"])
+
+    def test_coalesce(self):
+        switcher = rcswitch.Switcher(command=self.command, batch=True, debounce=0.2)
+        self.addCleanup(switcher.shutdown)
+        switcher.submit(["a"], "on")
+        switcher.submit(["a"], "off")
+        switcher.submit(["b"], "off")
+        future = switcher.submit(["a"], "on")
+        self.assertEqual(future.result(5), [0, 0])
+        self.assertEqual(self.calls(), ["b off", "a on"])
+        self.assertEqual(switcher.stats(), {"pending": 0, "sent": 2, "coalesced": 2})
+
 
 class TestYoutubeMethods(unittest.TestCase):
     def test_link_parser(self):
@@ -71,6 +970,308 @@ class TestYoutubeMethods(unittest.TestCase):
         self.assertRaises(yt.ParseError, yt.parse_yt_url, "https://youtu.be/?foo=bar")
         self.assertRaises(yt.ParseError, yt.parse_yt_url, "https://youtube.com/ivroIGMAVig")
 
+    def test_playlist_parser(self):
+        self.assertEqual(yt.parse_yt_playlist("https://www.youtube.com/playlist?list=PLabc_-1"), "PLabc_-1")
+        self.assertEqual(yt.parse_yt_playlist("youtube.com/playlist?foo=bar&list=PLabc&index=2"), "PLabc")
+        self.assertRaises(yt.ParseError, yt.parse_yt_playlist, "https://www.youtube.com/watch?v=ivroIGMAVig")
+        self.assertRaises(yt.ParseError, yt.parse_yt_playlist, "https://www.youtube.com/playlist?foo=bar")
+
+    def test_bulk_linkshare(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = Journal(os.path.join(tmp, "queue.journal"))
+            streamer = Collector(journal, capacity=5)
+            streamer.release.clear()
+            endpoint = yt.LinkshareEndpoint("/linkshare", None, streamer, FakePlugin())
+            server = serve(self, endpoint)
+
+            def post(data):
+                resp = request(self, server, "POST", "/linkshare", json.dumps(data))
+                return resp.status, json.loads(resp.body or "null")
+
+            status, results = post({"links": ["https://youtu.be/a", "foo", "https://youtube.com/playlist?list=PL",
+                                              "https://youtu.be/b"]})
+            self.assertEqual(status, 202)
+            self.assertEqual([el["status"] for el in results], ["queued", "invalid", "expanding", "queued"])
+            self.assertEqual(results[2]["playlist"], "PL")
+            endpoint.expander.submit(lambda: None).result(5)
+            # the playlist had 3 videos: all fit
+            self.assertEqual([el for _, el in journal.pending()], ["a", "b", "PL-0", "PL-1", "PL-2"])
+
+            status, results = post(["https://youtu.be/c"])
+            self.assertEqual(status, 503)
+            self.assertEqual(results, [{"link": "https://youtu.be/c", "status": "full", "id": "c"}])
+            status, results = post(["https://youtube.com/playlist?list=PL"])
+            self.assertEqual(status, 503)
+            self.assertEqual(results[0]["status"], "full")
+            self.assertEqual(post(["foo"])[0], 422)
+
+            streamer.release.set()
+            wait_until(lambda: len(streamer.seen) == 5)
+            self.assertEqual(streamer.seen, ["a", "b", "PL-0", "PL-1", "PL-2"])
+
+    def test_video_cache(self):
+        with tempfile.TemporaryDirectory() as videodir:
+            touch(videodir, "a.mp4")
+            touch(videodir, "b.f137.mp4")
+            touch(videodir, "c.mkv.part")
+            cache = yt.VideoCache(videodir)
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(cache.get("a"), videodir + "/a.mp4")
+            self.assertEqual(cache.get("b"), None)
+
+            touch(videodir, "c.mkv")
+            self.assertEqual(cache.get("c"), None)
+            self.assertEqual(cache.add("c"), videodir + "/c.mkv")
+            self.assertEqual(cache.get("c"), videodir + "/c.mkv")
+            self.assertEqual(cache.add("d"), None)
+
+            cache.remove("a")
+            self.assertNotIn("a", cache)
+            self.assertFalse(os.path.exists(videodir + "/a.mp4"))
+
+    def test_video_cache_quota(self):
+        with tempfile.TemporaryDirectory() as videodir:
+            cache = yt.VideoCache(videodir, max_bytes=30)
+            for videoid in ["a", "b", "c"]:
+                touch(videodir, videoid + ".mp4", 10)
+                cache.add(videoid)
+                cache.release(videoid)
+            self.assertEqual(cache.stats()["bytes"], 30)
+
+            # "a" was played least recently, but is pinned; "b" is in use
+            cache.pin("a")
+            self.assertEqual(cache.acquire("b"), videodir + "/b.mp4")
+            touch(videodir, "d.mp4", 10)
+            cache.add("d")
+            self.assertEqual(sorted(cache.index), ["a", "b", "d"])
+            self.assertFalse(os.path.exists(videodir + "/c.mp4"))
+
+            self.assertEqual(cache.acquire("c"), None)
+            stats = cache.stats()
+            self.assertEqual((stats["bytes"], stats["evictions"], stats["hit_rate"]), (30, 1, 0.5))
+
+            # pins survive a restart
+            self.assertEqual(yt.VideoCache(videodir).pinned, {"a"})
+
+    def test_video_cache_order(self):
+        with tempfile.TemporaryDirectory() as videodir:
+            for i, videoid in enumerate(["a", "b", "c"]):
+                touch(videodir, videoid + ".mp4")
+                os.utime(os.path.join(videodir, videoid + ".mp4"), (1000 + i, 1000 + i))
+            cache = yt.VideoCache(videodir)
+            self.assertEqual(list(cache.index), ["a", "b", "c"])
+
+            cache.acquire("a")
+            cache.release("a")
+            self.assertGreater(os.stat(videodir + "/a.mp4").st_mtime, 2000)
+
+            # a rescan keeps the known entries in place and only picks up changes
+            os.remove(videodir + "/b.mp4")
+            touch(videodir, "d.mp4")
+            os.utime(videodir + "/d.mp4", (1500, 1500))
+            cache.scan()
+            self.assertEqual(list(cache.index), ["c", "d", "a"])
+
+            # the play time survives a restart
+            self.assertEqual(list(yt.VideoCache(videodir).index), ["c", "d", "a"])
+
+    def test_resolve_cache(self):
+        cache = yt.ResolveCache(size=2, ttl=100, margin=10)
+        now = int(time.time())
+        video = "https://r1.googlevideo.com/videoplayback?expire={}&id=1".format(now + 1000)
+        audio = "https://r1.googlevideo.com/videoplayback/expire/{}/id/1".format(now + 500)
+
+        self.assertEqual(yt.url_expiry(video), now + 1000)
+        self.assertEqual(yt.url_expiry(audio), now + 500)
+        self.assertEqual(yt.url_expiry("https://example.com/video"), None)
+
+        cache.put("a", (video, audio))
+        self.assertEqual(cache.entries["a"].expires, now + 490)
+        self.assertEqual(cache.get("a"), (video, audio))
+        self.assertEqual(cache.expiring(600, 1), ["a"])
+        self.assertEqual(cache.expiring(600, 2), [])
+
+        cache.put("b", ("https://example.com/video", "https://example.com/audio"))
+        self.assertGreater(cache.entries["b"].expires, now + 90)
+        cache.put("c", (video, audio))
+        self.assertEqual(cache.get("a"), None)  # evicted, least recently used
+
+        cache.put("d", ("https://example.com/videoplayback?expire={}".format(now + 5), audio))
+        self.assertEqual(cache.get("d"), None)  # expires within the margin
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_downloader_order(self):
+        with tempfile.TemporaryDirectory() as videodir:
+            touch(videodir, "cached.mp4")
+            player = FakePlayer()
+            downloader = FakeDownloader(videodir, player, workers=2, prefetch_depth=4)
+            for videoid in ["a", "b", "cached", "a"]:
+                downloader.release[videoid] = Event()
+            for videoid in ["a", "b", "cached", "a"]:
+                downloader.consume(videoid)
+
+            downloader.release["b"].set()
+            downloader.workers.submit(lambda: None).result()
+            self.assertEqual(player.played, [])
+
+            downloader.release["a"].set()
+            downloader.workers.shutdown(wait=True)
+            self.assertEqual(player.played, ["a.mp4", "b.mp4", "cached.mp4", "a.mp4"])
+            self.assertEqual(sorted(downloader.downloads), ["a", "b"])
+
+    def test_stop_threads(self):
+        with tempfile.TemporaryDirectory() as videodir:
+            cache = yt.VideoCache(videodir, watch_interval=10)
+            cache.stop()
+            cache._watcher.join(1)
+            self.assertFalse(cache._watcher.is_alive())
+
+            streamer = yt.Streamer(videodir, FakePlayer(), refresh_hits=1, extractor=yt.StubExtractor())
+            streamer.stop()
+            streamer._refresher.join(1)
+            self.assertFalse(streamer._refresher.is_alive())
+
+    def test_downloader_failure(self):
+        with tempfile.TemporaryDirectory() as videodir:
+            player = FakePlayer()
+            plugin = FakePlugin()
+            downloader = FakeDownloader(videodir, player, plugin, workers=2, prefetch_depth=4)
+            downloader.fail.add("bad")
+            downloader.release["a"] = Event()
+            downloader.release["a"].set()
+            downloader.consume("bad")
+            downloader.consume("a")
+            downloader.workers.shutdown(wait=True)
+            self.assertEqual(player.played, ["a.mp4"])
+            self.assertEqual(downloader.backlog(), 0)
+            self.assertEqual(len(plugin.errors), 1)
+            self.assertIn("bad", plugin.errors[0])
+
+    def test_stub_extractor(self):
+        self.assertEqual(yt.parse_bytes("50K"), 50 * 1024)
+        self.assertEqual(yt.parse_bytes("1.5m"), int(1.5 * 1024 ** 2))
+        self.assertEqual(yt.parse_bytes("10"), 10)
+        self.assertEqual(yt.parse_bytes("fast"), None)
+        self.assertIsInstance(yt.make_extractor("nonexistent"), yt.CLIExtractor)
+
+        extractor = yt.make_extractor("stub")
+        video, audio = extractor.resolve("a")
+        self.assertIsNotNone(yt.url_expiry(video))
+
+        with tempfile.TemporaryDirectory() as videodir:
+            player = FakePlayer()
+            downloader = yt.Downloader(videodir, player, extractor=extractor)
+            downloader.consume("a")
+            downloader.workers.shutdown(wait=True)
+            self.assertEqual(player.played, ["a.mp4"])
+
+    def test_downloader_prefetch(self):
+        with tempfile.TemporaryDirectory() as videodir:
+            player = FakePlayer()
+            downloader = FakeDownloader(videodir, player, workers=4, prefetch_depth=1)
+            for videoid in ["a", "b", "c", "d"]:
+                downloader.release[videoid] = Event()
+                downloader.release[videoid].set()
+                downloader.consume(videoid)
+            wait_until(lambda: len(player.played) == 2)
+
+            # "a" is playing, "b" is queued
+            self.assertEqual(player.played, ["a.mp4", "b.mp4"])
+            self.assertEqual([videoid for videoid, _ in downloader.waiting], ["c", "d"])
+
+            player.finish()
+            downloader.prefetch()
+            downloader.workers.shutdown(wait=True)
+            self.assertEqual(player.played, ["a.mp4", "b.mp4", "c.mp4"])
+
+
+class FakePlayer:
+    def __init__(self):
+        self.played = []
+        self.finished = 0
+
+    def append(self, videofile):
+        self.played.append(os.path.basename(videofile))
+
+    def backlog(self):
+        return len(self.played) - self.finished
+
+    def finish(self):
+        self.finished += 1
+
+
+class FakePlugin:
+    name = "yt"
+
+    def __init__(self):
+        self.errors = []
+
+    def report_error(self, msg):
+        self.errors.append(msg)
+
+
+class FakeDownloader(yt.Downloader):
+    def __init__(self, *args, **kwargs):
+        self.downloads = []
+        self.release = {}
+        self.fail = set()
+        super().__init__(*args, **kwargs)
+
+    def fetch(self, videoid):
+        self.downloads.append(videoid)
+        if videoid in self.fail:
+            raise FileNotFoundError("youtube-dl")
+        self.release[videoid].wait(5)
+        touch(self.videodir, videoid + ".mp4")
+        return self.cache.add(videoid)
+
+
+class Collector(yt.Queue):
+    """
+    Queue that records the elements it consumes; consuming waits until release is set.
+    """
+    def __init__(self, journal=None, capacity=None):
+        self.seen = []
+        self.release = Event()
+        self.release.set()
+        self.extractor = yt.StubExtractor()
+        super().__init__(journal, capacity)
+
+    def consume(self, el):
+        self.release.wait(5)
+        self.seen.append(el)
+
+
+def serve(testcase, *endpoints, **config):
+    """
+    Starts a RESTServer without plugins on a free port; it is shut down on cleanup of testcase.
+    """
+    server = restserver.RESTServer(dict({"port": 0, "plugindir": None}, **config))
+    for endpoint in endpoints:
+        server.register_endpoint(endpoint)
+    Thread(target=server.serve_forever, daemon=True).start()
+    testcase.addCleanup(server.shutdown)
+    return server
+
+
+def request(testcase, server, method, path, body=None):
+    """
+    Sends a request on a new connection.
+    :return: HTTPResponse; its body was read into resp.body
+    """
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+    testcase.addCleanup(conn.close)
+    conn.request(method, path, body)
+    resp = conn.getresponse()
+    resp.body = resp.read()
+    return resp
+
+
+def wait_until(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,22 +1,148 @@
-class Stack:
-    def __init__(self):
-        self._stack = []
+from threading import Lock, Thread
+from collections import OrderedDict
+import json
+import os
+import time
 
-    def is_empty(self):
-        if not self._stack:
-            return True
+
+class Journal:
+    """
+    Append-only journal of queue items, one JSON object per line: {"a": seq, "i": item} when an item is added,
+    {"d": seq} when it is done. pending() returns the items that were added but not done, e.g. after a restart.
+    The file is rewritten with only the pending items once it holds more than compact_threshold records and
+    less than half of them are pending.
+    """
+    def __init__(self, path, fsync_interval=0, compact_threshold=1000):
+        """
+        :param path: Journal file; created if missing
+        :param fsync_interval: 0: fsync after every write. None: never fsync (writes still reach the OS,
+                               so they survive a crash of the server, but not a power loss).
+                               Otherwise: fsync at most every fsync_interval seconds from a background thread.
+        :param compact_threshold: Minimum number of records before the journal is compacted
+        """
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self.lock = Lock()
+        self._items = OrderedDict()  # seq: item, added but not done
+        self._next = 0
+        self._records = 0
+        self._dirty = False
+        self._closed = False
+        self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+        self._syncer = None
+        if self.fsync_interval:
+            self._syncer = Thread(target=self._sync_loop, daemon=True)
+            self._syncer.start()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _load(self):
+        try:
+            f = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        torn = False
+        with f:
+            for line in f:
+                torn = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # partially written record, e.g. after a power loss
+                    continue
+                self._records += 1
+                if "a" in record:
+                    self._items[record["a"]] = record["i"]
+                    self._next = max(self._next, record["a"] + 1)
+                elif "d" in record:
+                    self._items.pop(record["d"], None)
+        if torn:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n")
+
+    def pending(self):
+        """
+        :return: List of (seq, item) tuples that were added but not done, oldest first
+        """
+        with self.lock:
+            return list(self._items.items())
+
+    def add(self, item):
+        """
+        :param item: JSON serializable item
+        :return: sequence number of item
+        """
+        with self.lock:
+            seq = self._next
+            self._next += 1
+            self._items[seq] = item
+            self._write({"a": seq, "i": item})
+            return seq
+
+    def add_many(self, items):
+        """
+        Adds items with a single write (and fsync).
+        :param items: list of JSON serializable items
+        :return: list of sequence numbers
+        """
+        with self.lock:
+            seqs = list(range(self._next, self._next + len(items)))
+            self._next += len(items)
+            for seq, item in zip(seqs, items):
+                self._items[seq] = item
+            self._write(*({"a": seq, "i": item} for seq, item in zip(seqs, items)))
+            return seqs
+
+    def done(self, seq):
+        with self.lock:
+            if seq not in self._items:
+                return
+            del self._items[seq]
+            self._write({"d": seq})
+            if self._records > self.compact_threshold and self._records > 2 * len(self._items) and not self._closed:
+                self._compact()
+
+    def _write(self, *records):
+        if self._closed or not records:
+            return
+        self._file.write("".join(json.dumps(record) + "\n" for record in records))
+        self._file.flush()
+        self._records += len(records)
+        if self.fsync_interval == 0:
+            os.fsync(self._file.fileno())
         else:
-            return False
+            self._dirty = True
+
+    def _compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for seq, item in self._items.items():
+                f.write(json.dumps({"a": seq, "i": item}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._records = len(self._items)
+        self._dirty = False
 
-    def push(self, el):
-        self._stack.append(el)
+    def sync(self):
+        with self.lock:
+            if self._dirty and not self._closed:
+                os.fsync(self._file.fileno())
+                self._dirty = False
 
-    def pop(self):
-        if self.is_empty():
-            raise IndexError("Stack is empty.")
-        return self._stack.pop()
+    def _sync_loop(self):
+        while not self._closed:
+            time.sleep(self.fsync_interval)
+            self.sync()
 
-    def top(self):
-        if self.is_empty():
-            raise IndexError("Stack is empty.")
-        return self._stack[-1]
+    def close(self):
+        self.sync()
+        with self.lock:
+            self._closed = True
+            self._file.close()